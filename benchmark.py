@@ -0,0 +1,57 @@
+import argparse
+import itertools
+import time
+
+import torch
+
+from model_backends import PRECISIONS, autocast, supported_precision
+from models import Wav2Lip, fuse_model
+from models.fused import load_checkpoint
+
+
+def time_model(model, batch_size, precision, channels_last, device, repeats=5):
+    """Seconds per face of one Wav2Lip forward pass at batch_size, the best of repeats after a warmup."""
+    mels = torch.randn(batch_size, 1, 80, 16, device=device)
+    faces = torch.rand(batch_size, 6, 96, 96, device=device)
+    if channels_last:
+        faces = faces.to(memory_format=torch.channels_last)
+
+    best = float("inf")
+    with torch.no_grad(), autocast(precision, device):
+        for i in range(repeats + 1):
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            model(mels, faces).float().cpu()
+            if i:  # the first run is the warmup
+                best = min(best, time.perf_counter() - start)
+    return best / batch_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time Wav2Lip at different batch sizes, precisions and memory formats")
+    parser.add_argument("--checkpoint", help="Wav2Lip checkpoint, random weights if not given (same speed)")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--precisions", nargs="+", choices=PRECISIONS, default=PRECISIONS)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--no_fuse", action="store_true", help="Time the model without folding its BatchNorms")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = load_checkpoint(args.checkpoint, device) if args.checkpoint else Wav2Lip().to(device).eval()
+    if not args.no_fuse:
+        model = fuse_model(model)
+    precisions = [p for p in args.precisions if supported_precision(p, device) == p]
+    print(f"device: {device}, skipping {sorted(set(args.precisions) - set(precisions)) or 'nothing'}")
+
+    print(f"{'batch':>6} {'precision':>9} {'layout':>13} {'ms/face':>8} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        baseline = None
+        for precision, channels_last in itertools.product(precisions, [False, True]):
+            layout = torch.channels_last if channels_last else torch.contiguous_format
+            seconds = time_model(
+                model.to(memory_format=layout), batch_size, precision, channels_last, device, args.repeats
+            )
+            baseline = baseline or seconds
+            name = "channels_last" if channels_last else "NCHW"
+            print(f"{batch_size:>6} {precision:>9} {name:>13} {seconds * 1000:>8.2f} {baseline / seconds:>7.2f}x")
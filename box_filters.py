@@ -0,0 +1,253 @@
+import math
+from collections import deque
+
+import numpy as np
+
+FILTERS = ["mean", "ema", "one_euro"]
+GAP_MODES = ["hold", "interpolate", "passthrough"]
+
+# chunk length for _linear_recurrence, keeps the running products inside float64 range
+_CHUNK = 64
+
+
+def _linear_recurrence(alpha, x):
+    """y[t] = alpha[t] * x[t] + (1 - alpha[t]) * y[t - 1] with y[0] = x[0], along axis 0.
+
+    Solved in closed form over chunks of _CHUNK frames with cumulative sums and
+    products, so the python loop runs once per chunk instead of once per frame.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float64), x.shape)
+    y = np.empty_like(x)
+    if len(x) == 0:
+        return y
+
+    # alpha = 1 would make the products 0, the difference of 1e-4 is invisible at pixel scale
+    log_b = np.log(np.clip(1 - alpha, 1e-4, 1))
+    prev = x[0]
+    for start in range(0, len(x), _CHUNK):
+        end = min(start + _CHUNK, len(x))
+        log_p = np.cumsum(log_b[start:end], axis=0)  # log of prod(1 - alpha) since the chunk start
+        terms = alpha[start:end] * x[start:end] * np.exp(-log_p)
+        y[start:end] = np.exp(log_p) * (prev + np.cumsum(terms, axis=0))
+        prev = y[end - 1]
+    return y
+
+
+def _smoothing_factor(cutoff, fps):
+    tau = 1.0 / (2 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau * fps)
+
+
+def moving_average(boxes, window=5):
+    """Average of each box and the window - 1 boxes after it, the last frames share the last window."""
+    boxes = np.asarray(boxes, dtype=np.float64)
+    n = len(boxes)
+    if n == 0:
+        return boxes
+    window = min(window, n)
+
+    totals = np.cumsum(np.concatenate([np.zeros((1,) + boxes.shape[1:]), boxes]), axis=0)
+    smoothed = np.empty_like(boxes)
+    smoothed[: n - window + 1] = (totals[window:] - totals[: n - window + 1]) / window
+    smoothed[n - window + 1 :] = smoothed[n - window]
+    return smoothed
+
+
+def exponential(boxes, alpha=0.5):
+    """Exponential moving average, alpha is the weight of the newest box."""
+    return _linear_recurrence(alpha, boxes)
+
+
+def one_euro(boxes, fps=25.0, min_cutoff=1.0, beta=0.02, d_cutoff=1.0):
+    """One euro filter: smooths strongly while the face is still and follows it closely when it moves.
+
+    The speed is estimated from the raw boxes rather than the filtered ones, which is what
+    lets the whole clip be filtered without a loop over frames.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if len(boxes) == 0:
+        return boxes
+    speed = np.diff(boxes, axis=0, prepend=boxes[:1]) * fps
+    speed = _linear_recurrence(_smoothing_factor(d_cutoff, fps), speed)
+    cutoff = min_cutoff + beta * np.abs(speed)
+    return _linear_recurrence(_smoothing_factor(cutoff, fps), boxes)
+
+
+def smooth_boxes(boxes, method="mean", window=5, alpha=0.5, fps=25.0, min_cutoff=1.0, beta=0.02, cuts=None):
+    """Smooth an (N, 4) array of boxes over time, keeping its dtype.
+
+    cuts is an optional boolean per box, True where a new shot starts. Every shot is
+    smoothed on its own, as if it was a separate clip.
+    """
+    boxes = np.asarray(boxes)
+    if cuts is not None and np.any(cuts):
+        starts = np.flatnonzero(cuts)
+        return np.concatenate(
+            [
+                smooth_boxes(shot, method, window, alpha, fps, min_cutoff, beta)
+                for shot in np.split(boxes, starts)
+                if len(shot)
+            ]
+        )
+
+    if method == "mean":
+        smoothed = moving_average(boxes, window)
+    elif method == "ema":
+        smoothed = exponential(boxes, alpha)
+    elif method == "one_euro":
+        smoothed = one_euro(boxes, fps, min_cutoff, beta)
+    else:
+        raise ValueError(f"Unknown box filter {method}, choose from {FILTERS}")
+    return smoothed.astype(boxes.dtype)
+
+
+def fill_gaps(boxes, found, mode="interpolate", max_gap=10, cuts=None):
+    """Fill in the boxes of frames where no face was found.
+
+    hold keeps the box of the last face, interpolate moves it in a straight line to the
+    next face over gaps of at most max_gap frames and passthrough fills nothing. Gaps are
+    never filled across a cut. Returns the boxes, in their dtype, and a boolean array
+    that is False for the frames still without a box, which should be left untouched.
+    """
+    if mode not in GAP_MODES:
+        raise ValueError(f"Unknown missing face mode {mode}, choose from {GAP_MODES}")
+    boxes = np.asarray(boxes)
+    found = np.asarray(found, dtype=bool)
+    n = len(found)
+    if mode == "passthrough" or n == 0:
+        return boxes, found.copy()
+
+    shot = np.cumsum(cuts) if cuts is not None else np.zeros(n, dtype=int)
+    frame = np.arange(n)
+    # index of the last face at or before every frame, -1 if there's none yet
+    before = np.maximum.accumulate(np.where(found, frame, -1))
+    has_before = before >= 0
+    before = np.maximum(before, 0)
+
+    filled = boxes.astype(np.float64)
+    if mode == "hold":
+        keep = has_before & (shot[before] == shot)
+        filled[keep] = boxes[before[keep]]
+        return filled.astype(boxes.dtype), keep
+
+    # index of the next face at or after every frame, n if there's none left
+    after = np.minimum.accumulate(np.where(found, frame, n)[::-1])[::-1]
+    has_after = after < n
+    after = np.minimum(after, n - 1)
+
+    gap = ~found & has_before & has_after & (after - before - 1 <= max_gap) & (shot[before] == shot[after])
+    t = ((frame[gap] - before[gap]) / (after[gap] - before[gap]))[:, None]
+    filled[gap] = (1 - t) * boxes[before[gap]] + t * boxes[after[gap]]
+    return filled.astype(boxes.dtype), found | gap
+
+
+class GapFillStream:
+    """Frame by frame version of fill_gaps.
+
+    push() takes the next box, or None when no face was found, and whether the frame is a
+    cut. It returns the filled boxes that are ready, in order, with None for the frames to
+    leave untouched. Interpolating holds frames back until the next face is found or the
+    gap is longer than max_gap. flush() returns whatever is still waiting at the end.
+    """
+
+    def __init__(self, mode="interpolate", max_gap=10):
+        if mode not in GAP_MODES:
+            raise ValueError(f"Unknown missing face mode {mode}, choose from {GAP_MODES}")
+        self.mode = mode
+        self.max_gap = max_gap
+        self.reset()
+
+    def reset(self):
+        self.last = None  # box of the last face in this shot
+        self.waiting = 0  # frames without a face since then
+
+    def push(self, box, cut=False):
+        ready = []
+        if cut:
+            ready = self.flush()
+        if self.mode == "passthrough":
+            return ready + [box]
+
+        if box is None:
+            if self.last is None:
+                return ready + [None]
+            if self.mode == "hold":
+                return ready + [self.last]
+            self.waiting += 1
+            if self.waiting > self.max_gap:
+                # too long to interpolate, leave the whole gap untouched
+                ready += self.flush()
+            return ready
+
+        box = np.asarray(box)
+        if self.waiting:
+            start = self.last.astype(np.float64)
+            for i in range(1, self.waiting + 1):
+                t = i / (self.waiting + 1)
+                ready.append(((1 - t) * start + t * box).astype(box.dtype))
+        self.last, self.waiting = box, 0
+        return ready + [box]
+
+    def flush(self):
+        # a gap that's still open at a cut or the end of the video has no face to move to
+        ready = [None] * self.waiting
+        self.reset()
+        return ready
+
+
+class BoxFilterStream:
+    """Frame by frame version of smooth_boxes, for when the boxes arrive one at a time.
+
+    push() takes the next box and returns the smoothed boxes that are ready, in order.
+    The mean filter needs window - 1 boxes of lookahead, the others return every box
+    straight away. flush() returns whatever is still waiting at the end of the video.
+    """
+
+    def __init__(self, method="mean", window=5, alpha=0.5, fps=25.0, min_cutoff=1.0, beta=0.02):
+        if method not in FILTERS:
+            raise ValueError(f"Unknown box filter {method}, choose from {FILTERS}")
+        self.method = method
+        self.window = window
+        self.alpha = alpha
+        self.fps = fps
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.reset()
+
+    def reset(self):
+        self.boxes = deque(maxlen=self.window)
+        self.waiting = 0
+        self.prev_box = self.prev_smoothed = self.prev_speed = None
+
+    def push(self, box):
+        box = np.asarray(box, dtype=np.float64)
+        if self.method == "mean":
+            self.boxes.append(box)
+            self.waiting += 1
+            if len(self.boxes) < self.window:
+                return []
+            self.waiting -= 1
+            return [np.mean(self.boxes, axis=0)]
+
+        if self.prev_box is None:
+            smoothed, speed = box, np.zeros_like(box)
+        else:
+            speed = (box - self.prev_box) * self.fps
+            if self.method == "ema":
+                alpha = self.alpha
+            else:
+                speed_alpha = _smoothing_factor(1.0, self.fps)
+                speed = speed_alpha * speed + (1 - speed_alpha) * self.prev_speed
+                alpha = _smoothing_factor(self.min_cutoff + self.beta * np.abs(speed), self.fps)
+            smoothed = alpha * box + (1 - alpha) * self.prev_smoothed
+        self.prev_box, self.prev_smoothed, self.prev_speed = box, smoothed, speed
+        return [smoothed]
+
+    def flush(self):
+        # the last boxes of the mean filter all share the last window, like moving_average
+        smoothed = []
+        if self.waiting:
+            smoothed = [np.mean(self.boxes, axis=0)] * self.waiting
+        self.reset()
+        return smoothed
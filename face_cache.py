@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# one record per frame, a score of 0 means no face was found in that frame
+# and cut marks the first frame of a new shot
+DETECTION_DTYPE = np.dtype(
+    [
+        ("box", np.int32, 4),
+        ("landmarks", np.float32, (5, 2)),
+        ("score", np.float32),
+        ("cut", np.bool_),
+    ]
+)
+
+
+def to_detections(faces, cuts=None):
+    """Pack (box, landmarks, score) tuples, or None for frames without a face, into a record array."""
+    detections = np.zeros(len(faces), dtype=DETECTION_DTYPE)
+    if cuts is not None:
+        detections["cut"] = cuts
+    for detection, face in zip(detections, faces):
+        if face is not None:
+            box, landmarks, score = face
+            detection["box"] = np.asarray(box).astype(np.int32)
+            detection["landmarks"] = landmarks
+            detection["score"] = score
+    return detections
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Hash of a file's content, so copies and renames of the same video share a key."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FaceCache:
+    """Face detection results for many videos, keyed by video content and detection settings.
+
+    Every entry is a .npy file of DETECTION_DTYPE records, one per frame, in cache_dir.
+    Reading an entry marks it as recently used, and the least recently used entries are
+    removed once the directory grows past max_size_mb.
+    """
+
+    extension = ".npy"
+
+    def __init__(self, cache_dir="face_cache", max_size_mb=2048):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, video_path, params):
+        # params must hold everything that changes the detection result for this video
+        h = hashlib.blake2b(digest_size=20)
+        h.update(file_hash(video_path).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.extension)
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path)  # the modification time is what the LRU eviction goes by
+        # copied out of the memory map so the file isn't kept open (and can be replaced on windows)
+        detections = np.array(np.load(path, mmap_mode="r"))
+        if detections.dtype != DETECTION_DTYPE:
+            return None  # written by an older version, detect again and overwrite it
+        return detections
+
+    def save(self, key, detections):
+        path = self.path(key)
+        # write to a temporary file first so an interrupted job never leaves a broken entry
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, np.asarray(detections, dtype=DETECTION_DTYPE))
+        os.replace(path + ".tmp", path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.extension):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
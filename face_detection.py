@@ -0,0 +1,290 @@
+import multiprocessing
+import os
+import sys
+import types
+from functools import partial
+from itertools import islice
+
+import cv2
+import numpy as np
+
+# rough peak memory of the mobilenet RetinaFace per input pixel, input tensor and feature maps included
+DETECTOR_BYTES_PER_PIXEL = 200
+
+
+def detection_scale(frame_shape, short_side):
+    """Scale that brings the frame's short side down to short_side, never upscaling. 0 means full resolution."""
+    frame_short_side = min(frame_shape[:2])
+    if short_side <= 0 or frame_short_side <= short_side:
+        return 1.0
+    return short_side / frame_short_side
+
+
+def available_memory(gpu_id=-1):
+    if gpu_id >= 0:
+        import torch
+
+        free, _ = torch.cuda.mem_get_info(gpu_id)
+        return free
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 2 * 1024**3  # not available on windows, assume a modest 2GB is free
+
+
+def auto_detection_settings(frame_shape, gpu_id=-1, max_batch_size=64):
+    """Pick a detection batch size and scale from the frame size and the free memory."""
+    # talking head sized faces are found just as well at 480p, bigger frames only cost time
+    scale = detection_scale(frame_shape, 480)
+    height, width = frame_shape[:2]
+    frame_bytes = height * width * scale * scale * DETECTOR_BYTES_PER_PIXEL
+
+    # leave most of the memory to the rest of the job
+    batch_size = int(available_memory(gpu_id) * 0.25 // frame_bytes)
+    return max(1, min(batch_size, max_batch_size)), scale
+
+
+def detect_faces(detector, images, scale=1.0):
+    """First face found in each image as (box, landmarks, score), or None.
+
+    The images are downscaled by scale before detection and the boxes and landmarks
+    are mapped back to full resolution.
+    """
+    images, factor = _downscale(images, scale)
+    return [_first_face(faces, factor) for faces in detector(images)]
+
+
+def detect_all_faces(detector, images, scale=1.0):
+    """Like detect_faces, but a list of every face found in each image."""
+    images, factor = _downscale(images, scale)
+    return [[_first_face([face], factor) for face in faces] for faces in detector(images)]
+
+
+def _downscale(images, scale):
+    # returns the images to detect on and the factor that maps their coordinates back
+    if scale == 1.0:
+        return images, np.ones(2)
+    height, width = images[0].shape[:2]
+    size = (round(width * scale), round(height * scale))
+    images = [cv2.resize(image, size, interpolation=cv2.INTER_AREA) for image in images]
+    return images, np.array([width / size[0], height / size[1]])
+
+
+def _first_face(faces, factor):
+    if not faces:
+        return None
+    box, landmarks, score = faces[0]
+    box = np.asarray(box[:4]).reshape(2, 2) * factor
+    landmarks = np.asarray(landmarks).reshape(5, 2) * factor
+    return box.reshape(4), landmarks, score
+
+
+def _scale_face(face, factor):
+    if face is None:
+        return None
+    box, landmarks, score = face
+    return (box.reshape(2, 2) * factor).reshape(4), landmarks * factor, score
+
+
+# the RetinaFace of a DetectorPool worker process
+_worker_detector = None
+
+
+def _init_worker(model_path, network, threads):
+    global _worker_detector
+    import torch
+    from batch_face import RetinaFace
+
+    torch.set_num_threads(threads)
+    _worker_detector = RetinaFace(gpu_id=-1, model_path=model_path, network=network)
+
+
+def _detect_in_worker(images, all_faces=False):
+    if all_faces:
+        return detect_all_faces(_worker_detector, images)
+    return detect_faces(_worker_detector, images)
+
+
+class DetectorPool:
+    """Face detection on a pool of CPU processes, each with its own RetinaFace.
+
+    One process with many torch threads scales badly on machines with lots of cores,
+    several processes with a few threads each scale with the core count. Called with a
+    list of images, which is downscaled here and split in batches of batch_size for the
+    workers, it returns the faces like detect_faces (or detect_all_faces with all_faces),
+    in order. Pass it at least workers * batch_size images at a time to keep every worker
+    busy. The processes are started on the first call, so an unused pool costs nothing.
+    """
+
+    def __init__(self, model_path, network, workers, batch_size=8, threads=None):
+        self.initargs = (model_path, network, threads or max(1, (os.cpu_count() or 1) // workers))
+        self.workers = workers
+        self.batch_size = batch_size
+        self.pool = None
+
+    def __call__(self, images, scale=1.0, all_faces=False):
+        if self.pool is None:
+            # spawn, torch doesn't survive being forked once its thread pool is running
+            context = multiprocessing.get_context("spawn")
+            # spawned processes re-run the main script (all of inference.py) unless it's hidden
+            # while they start, the workers only need this module
+            main = sys.modules["__main__"]
+            sys.modules["__main__"] = types.ModuleType("__main__")
+            try:
+                self.pool = context.Pool(self.workers, _init_worker, self.initargs)
+            finally:
+                sys.modules["__main__"] = main
+
+        images, factor = _downscale(images, scale)
+        batches = [images[i : i + self.batch_size] for i in range(0, len(images), self.batch_size)]
+        faces = []
+        for batch_faces in self.pool.map(partial(_detect_in_worker, all_faces=all_faces), batches):
+            if all_faces:
+                faces += [[_scale_face(face, factor) for face in image_faces] for image_faces in batch_faces]
+            else:
+                faces += [_scale_face(face, factor) for face in batch_faces]
+        return faces
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _thumbnail(image):
+    return cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (64, 64), interpolation=cv2.INTER_AREA)
+
+
+class _Keyframe:
+    # what's needed to follow the face found on a keyframe through the next frames
+    def __init__(self, image, face, template_width):
+        self.face = face
+        self.thumbnail = _thumbnail(image)
+        if face is None:
+            return
+
+        height, width = image.shape[:2]
+        x1, y1, x2, y2 = np.asarray(face[0]).round().astype(int)
+        self.x1, self.y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(width, x2), min(height, y2)
+        self.size = (max(1, x2 - self.x1), max(1, y2 - self.y1))
+
+        # the template is matched at a small size, tracking doesn't need full resolution
+        self.t = min(1.0, template_width / self.size[0])
+        template = cv2.cvtColor(image[self.y1 : y2, self.x1 : x2], cv2.COLOR_BGR2GRAY)
+        self.template = cv2.resize(template, self._scaled(self.size))
+
+    def _scaled(self, size):
+        return (max(1, round(size[0] * self.t)), max(1, round(size[1] * self.t)))
+
+    def follow(self, image, min_confidence):
+        """The keyframe's face moved to where it best matches in image, or False if there's no good match."""
+        if self.face is None:
+            return None
+
+        height, width = image.shape[:2]
+        w, h = self.size
+        margin = max(w, h) // 2
+        sx1, sy1 = max(0, self.x1 - margin), max(0, self.y1 - margin)
+        sx2, sy2 = min(width, self.x1 + w + margin), min(height, self.y1 + h + margin)
+        search_size = self._scaled((sx2 - sx1, sy2 - sy1))
+        if search_size[0] < self.template.shape[1] or search_size[1] < self.template.shape[0]:
+            return False
+
+        search = cv2.cvtColor(image[sy1:sy2, sx1:sx2], cv2.COLOR_BGR2GRAY)
+        search = cv2.resize(search, search_size)
+        result = cv2.matchTemplate(search, self.template, cv2.TM_CCOEFF_NORMED)
+        _, confidence, _, (mx, my) = cv2.minMaxLoc(result)
+        if confidence < min_confidence:
+            return False
+
+        shift = np.array([sx1 + mx / self.t - self.x1, sy1 + my / self.t - self.y1])
+        box, landmarks, score = self.face
+        box = (np.asarray(box).reshape(2, 2) + shift).reshape(4)
+        return box, np.asarray(landmarks) + shift, score
+
+
+def track_faces(frames, detect, interval=10, min_confidence=0.6, max_motion=12.0, template_width=48, probe_every=8):
+    """Detect faces only on keyframes and follow them with template matching in between.
+
+    frames yields (image, cut) pairs, cut being True when the image starts a new shot.
+    A keyframe is taken at every cut and every interval frames (never, if interval is 0),
+    and earlier when the frame has changed too much since the last keyframe (mean absolute
+    difference of small grayscale thumbnails above max_motion) or the face can't be matched
+    with at least min_confidence. A keyframe without a face is followed by another every
+    probe_every frames, so a face that comes into a shot that opened without one is found
+    even when interval is 0. detect is called with a list of one image and returns a list
+    of one face like detect_faces. Yields (image, cut, face) for every image.
+    """
+    keyframe = None
+    since_keyframe = 0
+    for image, cut in frames:
+        face = False
+        if keyframe is not None and not cut and (interval == 0 or since_keyframe < interval):
+            motion = cv2.absdiff(_thumbnail(image), keyframe.thumbnail).mean()
+            if motion <= max_motion:
+                face = keyframe.follow(image, min_confidence)
+            if face is None and since_keyframe >= probe_every:
+                face = False
+
+        if face is False:
+            face = detect([image])[0]
+            keyframe = _Keyframe(image, face, template_width)
+            since_keyframe = 0
+
+        since_keyframe += 1
+        yield image, cut, face
+
+
+def probe_faces(frames, detect, batch_size=8, probe_every=8):
+    """Detect faces in every frame, but only probe every probe_every frames where there are none.
+
+    frames yields (image, cut) pairs. While faces are being found the frames are detected
+    in batches of batch_size. After a batch without any face only every probe_every-th
+    frame, and every cut, is detected until a face shows up again. The frames skipped
+    since the previous probe are then detected as well, so a face is only missed if it
+    comes and goes between two probes. detect works like detect_faces. Yields
+    (image, cut, face) for every image.
+    """
+    frames = iter(frames)
+    faceless = False
+    while 1:
+        if not faceless:
+            batch = list(islice(frames, batch_size))
+            if not batch:
+                break
+            faces = detect([image for image, _ in batch])
+            faceless = all(face is None for face in faces)
+            for (image, cut), face in zip(batch, faces):
+                yield image, cut, face
+            continue
+
+        # a cut ends the chunk early so the first frame of every shot is probed
+        chunk = []
+        for image, cut in frames:
+            chunk.append((image, cut))
+            if cut or len(chunk) >= probe_every:
+                break
+        if not chunk:
+            break
+
+        probe = detect([chunk[-1][0]])[0]
+        if probe is None:
+            for image, cut in chunk:
+                yield image, cut, None
+            continue
+
+        skipped = chunk[:-1]
+        faces = []
+        for start in range(0, len(skipped), batch_size):
+            faces += detect([image for image, _ in skipped[start : start + batch_size]])
+        for (image, cut), face in zip(chunk, faces + [probe]):
+            yield image, cut, face
+        faceless = False
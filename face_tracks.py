@@ -0,0 +1,64 @@
+import numpy as np
+
+
+def iou(a, b):
+    """Intersection over union of every box in a with every box in b, x1, y1, x2, y2 boxes."""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(1, -1, 4)
+    w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = w * h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return intersection / np.maximum(area_a + area_b - intersection, 1e-6)
+
+
+class FaceTracker:
+    """Gives every face a track id that stays the same from frame to frame.
+
+    Faces are matched to the track whose last box overlaps them the most, best
+    overlaps first, if the intersection over union is at least min_iou. Faces that
+    don't match any track start a new one, numbered in the order they appear, left to
+    right within a frame. Tracks that lose their face are kept, so a person who comes
+    back to the same place after a cutaway gets their old id back, unless max_age
+    frames go by first (0 keeps them forever).
+    """
+
+    def __init__(self, min_iou=0.3, max_age=0):
+        self.min_iou = min_iou
+        self.max_age = max_age
+        self.boxes = []  # last box of every track, by id
+        self.last_seen = []
+        self.frame = 0
+
+    def update(self, boxes):
+        """Track id of each of this frame's boxes."""
+        ids = [None] * len(boxes)
+        live = [
+            t
+            for t in range(len(self.boxes))
+            if self.max_age == 0 or self.frame - self.last_seen[t] <= self.max_age
+        ]
+        if live and len(boxes):
+            overlaps = iou([self.boxes[t] for t in live], boxes)
+            taken = set()
+            for flat in np.argsort(-overlaps, axis=None):
+                t, f = np.unravel_index(flat, overlaps.shape)
+                if overlaps[t, f] < self.min_iou:
+                    break
+                if live[t] in taken or ids[f] is not None:
+                    continue
+                ids[f] = live[t]
+                taken.add(live[t])
+
+        for f in sorted(range(len(boxes)), key=lambda f: boxes[f][0]):
+            if ids[f] is None:
+                ids[f] = len(self.boxes)
+                self.boxes.append(None)
+                self.last_seen.append(None)
+        for f, t in enumerate(ids):
+            self.boxes[t] = np.asarray(boxes[f])
+            self.last_seen[t] = self.frame
+
+        self.frame += 1
+        return ids
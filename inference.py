@@ -4,18 +4,12 @@ import torch
 print("\rloading numpy       ", end="")
 import numpy as np
 
-print("\rloading Image       ", end="")
-from PIL import Image
-
 print("\rloading argparse    ", end="")
 import argparse
 
 print("\rloading configparser", end="")
 import configparser
 
-print("\rloading math        ", end="")
-import math
-
 print("\rloading os          ", end="")
 import os
 
@@ -40,6 +34,15 @@ import re
 print("\rloading partial     ", end="")
 from functools import partial
 
+print("\rloading itertools   ", end="")
+from itertools import islice, chain, repeat
+
+print("\rloading collections ", end="")
+from collections import deque
+
+print("\rloading threading   ", end="")
+import threading
+
 print("\rloading tqdm        ", end="")
 from tqdm import tqdm
 
@@ -58,13 +61,47 @@ from enhance import load_sr
 print("\rloading load_model  ", end="")
 from easy_functions import load_model, g_colab
 
+print("\rloading fuse_model  ", end="")
+from models.fused import fuse_model
+
+print("\rloading backends    ", end="")
+from model_backends import CompiledModel, OnnxModel, BACKENDS, PRECISIONS, supported_precision, autocast
+
+print("\rloading pipeline    ", end="")
+from pipeline import prefetch, ordered_map
+
+print("\rloading face_cache  ", end="")
+from face_cache import FaceCache, to_detections, DETECTION_DTYPE
+
+print("\rloading detection   ", end="")
+from face_detection import (
+    detect_faces,
+    detect_all_faces,
+    detection_scale,
+    auto_detection_settings,
+    track_faces,
+    probe_faces,
+    DetectorPool,
+)
+
+print("\rloading scene_cuts  ", end="")
+from scene_cuts import SceneCutDetector, mark_cuts, spans
+
+print("\rloading box_filters ", end="")
+from face_tracks import FaceTracker
+from box_filters import smooth_boxes, BoxFilterStream, FILTERS, fill_gaps, GapFillStream, GAP_MODES
+
+print("\rloading masks       ", end="")
+from masks import alpha_blend_batch, MaskEngine
+
+print("\rloading video_io    ", end="")
+from video_io import read_frames, read_frames_ffmpeg, get_fps, FFmpegWriter
+
 print("\rimports loaded!     ")
 
 device = 'cuda' if torch.cuda.is_available() else 'mps' if torch.backends.mps.is_available() else 'cpu'
 gpu_id = 0 if torch.cuda.is_available() else -1
 
-if device == 'cpu':
-    print('Warning: No GPU detected so inference will be done on the CPU which is VERY SLOW!')
 parser = argparse.ArgumentParser(
     description="Inference code to lip-sync videos in the wild using Wav2Lip models"
 )
@@ -96,6 +133,28 @@ parser.add_argument(
     help="Filepath of video/audio file to use as raw audio source",
     required=True,
 )
+parser.add_argument(
+    "--track_audio",
+    type=str,
+    nargs="+",
+    default=None,
+    help="Lip sync several people at once: one audio file per speaker, with only that speaker's voice. "
+    "The first file drives face 0, the second face 1 and so on (or the faces given with --track_faces), "
+    "--audio is still the sound of the output",
+)
+parser.add_argument(
+    "--track_faces",
+    type=int,
+    nargs="+",
+    default=None,
+    help="Face ids, as listed after face detection, driven by each --track_audio file. Defaults to 0, 1, 2...",
+)
+parser.add_argument(
+    "--max_faces",
+    type=int,
+    default=4,
+    help="Most faces tracked in a frame with --track_audio, the most confident detections are kept",
+)
 parser.add_argument(
     "--outfile",
     type=str,
@@ -169,6 +228,288 @@ parser.add_argument(
     help="Prevent smoothing face detections over a short temporal window",
 )
 
+parser.add_argument(
+    "--streaming",
+    default=False,
+    action="store_true",
+    help="Decode, detect, process and write the video frame by frame instead of loading it all into memory first. "
+    "Memory use then depends on the batch size and smoothing window rather than the length of the video",
+)
+
+parser.add_argument(
+    "--decoder",
+    type=str,
+    default="opencv",
+    choices=["opencv", "ffmpeg"],
+    help="Video decoder. ffmpeg resizes, rotates and crops in its filter graph instead of frame by frame in python",
+)
+
+parser.add_argument(
+    "--encoder",
+    type=str,
+    default="opencv",
+    choices=["opencv", "ffmpeg"],
+    help="Video encoder. ffmpeg encodes to h264 and adds the audio in a single pass instead of writing "
+    "an intermediate file and re-encoding it",
+)
+
+parser.add_argument(
+    "--x264_preset",
+    type=str,
+    default="medium",
+    help="libx264 preset used for the output video, eg: veryfast, medium, slow",
+)
+
+parser.add_argument(
+    "--x264_crf",
+    type=int,
+    default=23,
+    help="libx264 constant rate factor used for the output video, lower is better quality",
+)
+
+parser.add_argument(
+    "--encoder_threads",
+    type=int,
+    default=0,
+    help="Number of threads for the ffmpeg encoder, 0 lets ffmpeg decide",
+)
+
+parser.add_argument(
+    "--fuse_model",
+    default=False,
+    action="store_true",
+    help="Fold Wav2Lip's BatchNorms into its convolutions before inference, same output with fewer ops",
+)
+
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="fp32",
+    choices=PRECISIONS,
+    help="Run Wav2Lip's layers in fp32, bf16 (recent CPUs and GPUs) or fp16 (GPUs) with autocast. "
+    "Falls back to fp32 where the device can't",
+)
+
+parser.add_argument(
+    "--channels_last",
+    default=False,
+    action="store_true",
+    help="Keep Wav2Lip's weights and input faces in channels last (NHWC) memory layout, "
+    "which the fast bf16/fp16 convolutions prefer",
+)
+
+parser.add_argument(
+    "--model_backend",
+    type=str,
+    default="eager",
+    choices=BACKENDS,
+    help="How Wav2Lip is run: eager, trace (TorchScript), compile (torch.compile) or onnxruntime, which also runs "
+    "the face detector. Traced and exported models are kept in model_cache_dir and compiled kernels under it, "
+    "so only the first run pays for it",
+)
+
+parser.add_argument(
+    "--int8_model",
+    type=str,
+    default="",
+    help="INT8 ONNX model made by quantize.py to run with onnxruntime instead of the checkpoint",
+)
+
+parser.add_argument(
+    "--model_cache_dir",
+    type=str,
+    default="model_cache",
+    help="Folder where traced and compiled models are kept between runs",
+)
+
+parser.add_argument(
+    "--pipeline",
+    default=False,
+    action="store_true",
+    help="Run decoding, face detection, Wav2Lip, blending and encoding concurrently in separate threads "
+    "so the post-processing overlaps with the model",
+)
+
+parser.add_argument(
+    "--model_workers",
+    type=int,
+    default=1,
+    help="Number of threads running the Wav2Lip model when --pipeline is used",
+)
+
+parser.add_argument(
+    "--blend_workers",
+    type=int,
+    default=2,
+    help="Number of threads resizing, masking and pasting faces back into frames when --pipeline is used",
+)
+
+parser.add_argument(
+    "--queue_size",
+    type=int,
+    default=4,
+    help="Maximum number of batches waiting between two pipeline stages",
+)
+
+parser.add_argument(
+    "--mouth_landmarks",
+    type=str,
+    default="hog",
+    choices=["hog", "dlib", "retinaface"],
+    help="How the mouth is found for the mask: hog runs dlib's face detector and then its 68 point "
+    "landmarks on the generated face, dlib runs only the landmarks inside the box face detection "
+    "already found, retinaface uses the mouth corners face detection already found (and dlib "
+    "inside the box for frames without them)",
+)
+
+parser.add_argument(
+    "--landmark_workers",
+    type=int,
+    default=4,
+    help="Threads finding the mouths of a batch at once with mouth_tracking",
+)
+
+parser.add_argument(
+    "--face_det_batch_size",
+    type=int,
+    default=8,
+    help="Number of frames sent to the face detector at once",
+)
+
+parser.add_argument(
+    "--face_det_size",
+    type=int,
+    default=0,
+    help="Downscale frames so their short side is this many pixels before detecting faces, "
+    "the boxes are scaled back to full resolution. 0 detects at full resolution",
+)
+
+parser.add_argument(
+    "--face_det_workers",
+    type=int,
+    default=0,
+    help="Run face detection in this many processes, each with its own detector. "
+    "Much faster on machines with many cores and no GPU, ignored when a GPU is used. 0 uses one process",
+)
+
+parser.add_argument(
+    "--face_det_threads",
+    type=int,
+    default=0,
+    help="Torch threads of every --face_det_workers process, 0 shares the cores between them",
+)
+
+parser.add_argument(
+    "--face_det_auto",
+    default=False,
+    action="store_true",
+    help="Choose the face detection batch size and scale from the frame size and free memory, "
+    "overrides --face_det_batch_size and --face_det_size",
+)
+
+parser.add_argument(
+    "--detect_every",
+    type=int,
+    default=1,
+    help="Only run face detection on every Nth frame and track the face in between. "
+    "Detection also runs when the picture changes too much or the face can't be tracked, "
+    "0 only detects then and at scene cuts",
+)
+
+parser.add_argument(
+    "--faceless_probe",
+    type=int,
+    default=8,
+    help="Where no face is found, only run face detection on every Nth frame until one shows up again. "
+    "The skipped frames are detected once it does, so shots without a face (eg: b-roll) cost 1/N of the detection. "
+    "With --detect_every, a shot that opens without a face is detected again every Nth frame. 1 detects every frame",
+)
+
+parser.add_argument(
+    "--missing_face",
+    type=str,
+    default="interpolate",
+    choices=GAP_MODES,
+    help="What to do with frames where no face is found: hold the last face box, interpolate it "
+    "to the next face over gaps of up to --max_face_gap frames, or pass the frames through untouched. "
+    "Frames that don't get a box are always passed through untouched",
+)
+
+parser.add_argument(
+    "--max_face_gap",
+    type=int,
+    default=10,
+    help="Longest run of frames without a face that --missing_face interpolate fills in",
+)
+
+parser.add_argument(
+    "--scene_cut_threshold",
+    type=float,
+    default=0,
+    help="Find cuts between shots, where box smoothing and face tracking start over and the face is "
+    "detected again. How different the brightness histograms of two frames must be, from 0 to 1. "
+    "0.3 is a good start, 0 disables it",
+)
+
+parser.add_argument(
+    "--face_cache_dir",
+    type=str,
+    default="face_cache",
+    help="Folder where face detection results are kept so they can be reused for the same video",
+)
+
+parser.add_argument(
+    "--face_cache_size",
+    type=int,
+    default=2048,
+    help="Maximum size of the face detection cache in MB, the least recently used videos are removed first. "
+    "0 disables the cache",
+)
+
+parser.add_argument(
+    "--redo_face_detection",
+    default=False,
+    action="store_true",
+    help="Ignore cached face detection results for this video (the new results are still cached)",
+)
+
+parser.add_argument(
+    "--box_filter",
+    type=str,
+    default="mean",
+    choices=FILTERS,
+    help="How face boxes are smoothed over time: mean of the next --smooth_window frames, "
+    "exponential moving average or one euro filter",
+)
+
+parser.add_argument(
+    "--smooth_window",
+    type=int,
+    default=5,
+    help="Number of frames averaged by the mean box filter",
+)
+
+parser.add_argument(
+    "--ema_alpha",
+    type=float,
+    default=0.5,
+    help="Weight of the newest box in the ema box filter",
+)
+
+parser.add_argument(
+    "--one_euro_min_cutoff",
+    type=float,
+    default=1.0,
+    help="Cutoff frequency in Hz of the one_euro box filter when the face is still, lower is smoother",
+)
+
+parser.add_argument(
+    "--one_euro_beta",
+    type=float,
+    default=0.02,
+    help="How quickly the one_euro box filter stops smoothing when the face moves",
+)
+
 parser.add_argument(
     "--no_seg",
     default=False,
@@ -236,15 +577,6 @@ parser.add_argument(
     default="Fast",
 )
 
-with open(os.path.join("checkpoints", "predictor.pkl"), "rb") as f:
-    predictor = pickle.load(f)
-
-with open(os.path.join("checkpoints", "mouth_detector.pkl"), "rb") as f:
-    mouth_detector = pickle.load(f)
-
-# creating variables to prevent failing when a face isn't detected
-kernel = last_mask = x = y = w = h = None
-
 g_colab = g_colab()
 
 if not g_colab:
@@ -257,316 +589,543 @@ if not g_colab:
 
 all_mouth_landmarks = []
 
-model = detector = detector_model = None
+sr_lock = threading.Lock()
+
+model = detector = detector_model = predictor = mouth_detector = None
+
+detector_model_path = "checkpoints/mobilenet.pth"
+detector_network = "mobilenet"
 
 def do_load(checkpoint_path):
-    global model, detector, detector_model
-    model = load_model(checkpoint_path)
+    # loaded here rather than on import, face detection worker processes import this module too
+    global model, detector, detector_model, predictor, mouth_detector
+    with open(os.path.join("checkpoints", "predictor.pkl"), "rb") as f:
+        predictor = pickle.load(f)
+
+    with open(os.path.join("checkpoints", "mouth_detector.pkl"), "rb") as f:
+        mouth_detector = pickle.load(f)
+
+    if args.int8_model:
+        print("Loading {}".format(args.int8_model))
+        model = OnnxModel(args.int8_model, device)
+    else:
+        model = load_model(checkpoint_path)
+        if args.fuse_model:
+            model = fuse_model(model)
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        precision = supported_precision(args.precision, device)
+        if precision != args.precision:
+            print(f"{args.precision} isn't supported on {device}, using {precision}")
+            args.precision = precision
+        variant = (args.fuse_model, args.channels_last, args.precision)  # all change what's traced
+        model = CompiledModel(model, args.model_backend, checkpoint_path, args.model_cache_dir, variant=repr(variant))
     detector = RetinaFace(
-        gpu_id=gpu_id, model_path="checkpoints/mobilenet.pth", network="mobilenet"
+        gpu_id=gpu_id, model_path=detector_model_path, network=detector_network
     )
     detector_model = detector.model
+    if args.model_backend == "onnxruntime":
+        # face detection sizes differ from video to video, the exported detector takes any
+        detector.model = CompiledModel(
+            detector_model, "onnxruntime", detector_model_path, args.model_cache_dir, dynamic_size=True
+        )
 
-def face_rect(images):
-    face_batch_size = 8
-    num_batches = math.ceil(len(images) / face_batch_size)
-    prev_ret = None
-    for i in range(num_batches):
-        batch = images[i * face_batch_size : (i + 1) * face_batch_size]
-        all_faces = detector(batch)  # return faces list of all images
-        for faces in all_faces:
-            if faces:
-                box, landmarks, score = faces[0]
-                prev_ret = tuple(map(int, box))
-            yield prev_ret
-
-def create_tracked_mask(img, original_img):
-    global kernel, last_mask, x, y, w, h  # Add last_mask to global variables
-
-    # Convert color space from BGR to RGB if necessary
-    cv2.cvtColor(img, cv2.COLOR_BGR2RGB, img)
-    cv2.cvtColor(original_img, cv2.COLOR_BGR2RGB, original_img)
-
-    # Detect face
-    faces = mouth_detector(img)
-    if len(faces) == 0:
-        if last_mask is not None:
-            last_mask = cv2.resize(last_mask, (img.shape[1], img.shape[0]))
-            mask = last_mask  # use the last successful mask
-        else:
-            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, img)
-            return img, None
+def face_rect(images, face_batch_size=8, scale=1.0):
+    # yields (image, detection) with a DETECTION_DTYPE record for the first face in every image
+    scene_cuts = None
+    if args.scene_cut_threshold > 0:
+        scene_cuts = SceneCutDetector(args.scene_cut_threshold)
+    frames = mark_cuts(images, scene_cuts, face_batch_size)
+
+    detect, face_batch_size, pool = face_detector(face_batch_size, scale)
+    if args.detect_every != 1:
+        faces = track_faces(frames, detect, args.detect_every, probe_every=args.faceless_probe)
+    elif args.faceless_probe > 1:
+        faces = probe_faces(frames, detect, face_batch_size, args.faceless_probe)
     else:
-        face = faces[0]
-        shape = predictor(img, face)
-
-        # Get points for mouth
-        mouth_points = np.array(
-            [[shape.part(i).x, shape.part(i).y] for i in range(48, 68)]
+        faces = detect_every_frame(frames, detect, face_batch_size)
+    try:
+        for image, cut, face in faces:
+            yield image, to_detections([face], [cut])[0]
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def face_detector(face_batch_size, scale, all_faces=False):
+    # returns the detect function, how many images to pass it at once and the DetectorPool
+    # to close once done, if detection runs in worker processes
+    if args.face_det_workers > 0 and gpu_id < 0:
+        pool = DetectorPool(
+            detector_model_path,
+            detector_network,
+            args.face_det_workers,
+            face_batch_size,
+            args.face_det_threads or None,
         )
+        detect = partial(pool, scale=scale, all_faces=all_faces)
+        return detect, face_batch_size * args.face_det_workers, pool  # a batch for every worker at once
 
-        # Calculate bounding box dimensions
-        x, y, w, h = cv2.boundingRect(mouth_points)
-
-        # Set kernel size as a fraction of bounding box size
-        kernel_size = int(max(w, h) * args.mask_dilation)
-        # if kernel_size % 2 == 0:  # Ensure kernel size is odd
-        # kernel_size += 1
-
-        # Create kernel
-        kernel = np.ones((kernel_size, kernel_size), np.uint8)
-
-        # Create binary mask for mouth
-        mask = np.zeros(img.shape[:2], dtype=np.uint8)
-        cv2.fillConvexPoly(mask, mouth_points, 255)
-
-        last_mask = mask  # Update last_mask with the new mask
-
-    # Dilate the mask
-    dilated_mask = cv2.dilate(mask, kernel)
-
-    # Calculate distance transform of dilated mask
-    dist_transform = cv2.distanceTransform(dilated_mask, cv2.DIST_L2, 5)
-
-    # Normalize distance transform
-    cv2.normalize(dist_transform, dist_transform, 0, 255, cv2.NORM_MINMAX)
-
-    # Convert normalized distance transform to binary mask and convert it to uint8
-    _, masked_diff = cv2.threshold(dist_transform, 50, 255, cv2.THRESH_BINARY)
-    masked_diff = masked_diff.astype(np.uint8)
-
-    # make sure blur is an odd number
-    blur = args.mask_feathering
-    if blur % 2 == 0:
-        blur += 1
-    # Set blur size as a fraction of bounding box size
-    blur = int(max(w, h) * blur)  # 10% of bounding box size
-    if blur % 2 == 0:  # Ensure blur size is odd
-        blur += 1
-    masked_diff = cv2.GaussianBlur(masked_diff, (blur, blur), 0)
-
-    # Convert numpy arrays to PIL Images
-    input1 = Image.fromarray(img)
-    input2 = Image.fromarray(original_img)
+    detect = partial(detect_all_faces if all_faces else detect_faces, detector, scale=scale)
+    return detect, face_batch_size, None
 
-    # Convert mask to single channel where pixel values are from the alpha channel of the current mask
-    mask = Image.fromarray(masked_diff)
-
-    # Ensure images are the same size
-    assert input1.size == input2.size == mask.size
-
-    # Paste input1 onto input2 using the mask
-    input2.paste(input1, (0, 0), mask)
-
-    # Convert the final PIL Image back to a numpy array
-    input2 = np.array(input2)
-
-    # input2 = cv2.cvtColor(input2, cv2.COLOR_BGR2RGB)
-    cv2.cvtColor(input2, cv2.COLOR_BGR2RGB, input2)
-
-    return input2, mask
-
-
-def create_mask(img, original_img):
-    global kernel, last_mask, x, y, w, h # Add last_mask to global variables
-
-    # Convert color space from BGR to RGB if necessary
-    cv2.cvtColor(img, cv2.COLOR_BGR2RGB, img)
-    cv2.cvtColor(original_img, cv2.COLOR_BGR2RGB, original_img)
-
-    if last_mask is not None:
-        last_mask = np.array(last_mask)  # Convert PIL Image to numpy array
-        last_mask = cv2.resize(last_mask, (img.shape[1], img.shape[0]))
-        mask = last_mask  # use the last successful mask
-        mask = Image.fromarray(mask)
 
+def detect_every_frame(frames, detect, face_batch_size):
+    while 1:
+        batch = list(islice(frames, face_batch_size))
+        if not batch:
+            break
+        faces = detect([image for image, _ in batch])  # return first face of all images
+        for (image, cut), face in zip(batch, faces):
+            yield image, cut, face
+
+
+def face_detection_settings(frame_shape):
+    if args.face_det_auto:
+        face_batch_size, scale = auto_detection_settings(frame_shape, gpu_id)
+        if args.face_det_workers > 0 and gpu_id < 0:
+            # every worker process holds a batch in memory
+            face_batch_size = max(1, face_batch_size // args.face_det_workers)
+        print(f"detecting faces in batches of {face_batch_size} at {scale:.2f}x scale")
+        return face_batch_size, scale
+    return args.face_det_batch_size, detection_scale(frame_shape, args.face_det_size)
+
+
+def cached_face_rect(images):
+    # same as face_rect, but frames that are already in the face cache are not detected
+    # again, and frames past the end of the cached entry are added to it
+    images = iter(images)
+    first = next(images, None)
+    if first is None:
+        return
+    images = chain([first], images)
+    face_batch_size, scale = face_detection_settings(first.shape)
+
+    cache = cached = None
+    if args.face_cache_size > 0:
+        cache = FaceCache(args.face_cache_dir, args.face_cache_size)
+        key = cache.key(args.face, face_detection_params(scale))
+        if not args.redo_face_detection:
+            cached = cache.load(key)
+
+    if cached is not None:
+        print("Using face detection data from a previous run on this video")
+        # cached goes first so zip doesn't take an extra image when the cached entry runs out
+        for detection, image in zip(cached, images):
+            yield image, detection
     else:
-        # Detect face
-        faces = mouth_detector(img)
-        if len(faces) == 0:
-            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, img)
-            return img, None
-        else:
-            face = faces[0]
-            shape = predictor(img, face)
-
-            # Get points for mouth
-            mouth_points = np.array(
-                [[shape.part(i).x, shape.part(i).y] for i in range(48, 68)]
-            )
-
-            # Calculate bounding box dimensions
-            x, y, w, h = cv2.boundingRect(mouth_points)
-
-            # Set kernel size as a fraction of bounding box size
-            kernel_size = int(max(w, h) * args.mask_dilation)
-            # if kernel_size % 2 == 0:  # Ensure kernel size is odd
-            # kernel_size += 1
-
-            # Create kernel
-            kernel = np.ones((kernel_size, kernel_size), np.uint8)
-
-            # Create binary mask for mouth
-            mask = np.zeros(img.shape[:2], dtype=np.uint8)
-            cv2.fillConvexPoly(mask, mouth_points, 255)
-
-            # Dilate the mask
-            dilated_mask = cv2.dilate(mask, kernel)
-
-            # Calculate distance transform of dilated mask
-            dist_transform = cv2.distanceTransform(dilated_mask, cv2.DIST_L2, 5)
-
-            # Normalize distance transform
-            cv2.normalize(dist_transform, dist_transform, 0, 255, cv2.NORM_MINMAX)
-
-            # Convert normalized distance transform to binary mask and convert it to uint8
-            _, masked_diff = cv2.threshold(dist_transform, 50, 255, cv2.THRESH_BINARY)
-            masked_diff = masked_diff.astype(np.uint8)
+        cached = to_detections([])
 
-            if not args.mask_feathering == 0:
-                blur = args.mask_feathering
-                # Set blur size as a fraction of bounding box size
-                blur = int(max(w, h) * blur)  # 10% of bounding box size
-                if blur % 2 == 0:  # Ensure blur size is odd
-                    blur += 1
-                masked_diff = cv2.GaussianBlur(masked_diff, (blur, blur), 0)
+    detected = []
+    for image, detection in face_rect(images, face_batch_size, scale):
+        detected.append(detection)
+        yield image, detection
 
-            # Convert mask to single channel where pixel values are from the alpha channel of the current mask
-            mask = Image.fromarray(masked_diff)
+    if cache is not None and detected:
+        cache.save(key, np.concatenate([cached, np.array(detected, dtype=cached.dtype)]))
 
-            last_mask = mask  # Update last_mask with the final mask after dilation and feathering
-
-    # Convert numpy arrays to PIL Images
-    input1 = Image.fromarray(img)
-    input2 = Image.fromarray(original_img)
-
-    # Resize mask to match image size
-    # mask = Image.fromarray(mask)
-    mask = mask.resize(input1.size)
-
-    # Ensure images are the same size
-    assert input1.size == input2.size == mask.size
-
-    # Paste input1 onto input2 using the mask
-    input2.paste(input1, (0, 0), mask)
-
-    # Convert the final PIL Image back to a numpy array
-    input2 = np.array(input2)
-
-    # input2 = cv2.cvtColor(input2, cv2.COLOR_BGR2RGB)
-    cv2.cvtColor(input2, cv2.COLOR_BGR2RGB, input2)
-
-    return input2, mask
-
-
-def get_smoothened_boxes(boxes, T):
-    for i in range(len(boxes)):
-        if i + T > len(boxes):
-            window = boxes[len(boxes) - T :]
-        else:
-            window = boxes[i : i + T]
-        boxes[i] = np.mean(window, axis=0)
-    return boxes
-            
-def face_detect(images, results_file="last_detected_face.pkl"):
-    # If results file exists, load it and return
-    if os.path.exists(results_file):
-        print("Using face detection data from last input")
-        with open(results_file, "rb") as f:
-            return pickle.load(f)
-
-    results = []
+def pad_box(image, rect):
     pady1, pady2, padx1, padx2 = args.pads
-    
+    y1 = max(0, rect[1] - pady1)
+    y2 = min(image.shape[0], rect[3] + pady2)
+    x1 = max(0, rect[0] - padx1)
+    x2 = min(image.shape[1], rect[2] + padx2)
+
+    return [x1, y1, x2, y2]
+
+
+def face_detection_params(scale):
+    # everything that changes the raw detections for a given video. padding and smoothing
+    # are applied after loading, and an entry can be reused for any number of frames
+    return {
+        "scale": round(scale, 4),
+        "detect_every": args.detect_every,
+        "scene_cut_threshold": args.scene_cut_threshold,
+        "faceless_probe": args.faceless_probe,
+        "out_height": args.out_height if args.fullres != 1 else None,
+        "crop": args.crop,
+        "rotate": args.rotate,
+        "decoder": args.decoder,
+        "detector": [detector_model_path, detector_network],
+    }
+
+
+def face_detect(images):
+    # returns the face of every frame as an (N, 14) array of face_boxes rows and whether
+    # each frame has one, the crops are taken from the frames when needed
+    detections = []
+
     tqdm_partial = partial(tqdm, position=0, leave=True)
-    for image, (rect) in tqdm_partial(
-        zip(images, face_rect(images)),
+    for image, detection in tqdm_partial(
+        cached_face_rect(images),
         total=len(images),
         desc="detecting face in every frame",
         ncols=100,
     ):
-        if rect is None:
-            cv2.imwrite(
-                "temp/faulty_frame.jpg", image
-            )  # check this frame where the face was not detected.
-            raise ValueError(
-                "Face not detected! Ensure the video contains a face in all the frames."
-            )
+        detections.append(detection)
+
+    faces, has_face = face_boxes(np.array(detections, dtype=DETECTION_DTYPE), images[0])
+    report_faceless(has_face)
+    return faces, has_face
+
+
+def face_boxes(detections, image):
+    # the padded, gap filled and smoothed box of one face through the video, and whether each
+    # frame has one. Every row is the x1, y1, x2, y2 box followed by the 5 landmark points,
+    # which are filled in and smoothed along with the box
+    boxes = np.array([pad_box(image, box) for box in detections["box"]], dtype=np.float64)
+    faces = np.concatenate([boxes.reshape(-1, 4), detections["landmarks"].reshape(-1, 10)], axis=1)
+    found = detections["score"] > 0
+    cuts = detections["cut"].copy()
+    faces, has_face = fill_gaps(faces, found, args.missing_face, args.max_face_gap, cuts)
+
+    if str(args.nosmooth) == "False" and has_face.any():
+        # every shot is smoothed on its own so boxes aren't blended across cuts,
+        # and frames that are left untouched split the video the same way
+        cuts[1:] |= ~has_face[:-1]
+        faces[has_face] = smooth_boxes(faces[has_face], cuts=cuts[has_face], **box_filter_params())
+
+    return faces, has_face
+
+
+def box_faces(n):
+    # face_boxes rows for the --box option, which has no landmarks
+    y1, y2, x1, x2 = args.box
+    faces = np.full((n, 14), np.nan)
+    faces[:, :4] = [x1, y1, x2, y2]
+    return faces
+
+
+def face_crop(frame, face):
+    # the crop, (y1, y2, x1, x2) coords and landmarks (None if unknown) of a face_boxes row
+    x1, y1, x2, y2 = (int(v) for v in face[:4])
+    landmarks = face[4:].reshape(5, 2)
+    if np.isnan(landmarks).any():
+        landmarks = None
+    return frame[y1:y2, x1:x2], (y1, y2, x1, x2), landmarks
+
+
+def face_detect_tracks(images):
+    # multi speaker version of face_detect: (tracks, N, 14) faces and (tracks, N) has_face
+    # for the face tracks chosen with --track_faces, in the order of --track_audio
+    detections = cached_face_tracks(images)
+
+    # a face only seen after the end of a shorter run of a cached video isn't in these frames
+    in_frames = [t for t in range(detections.shape[1]) if (detections[:, t]["score"] > 0).any()]
+    print(f"\n{len(in_frames)} faces found:")
+    for t in in_frames:
+        seen = np.flatnonzero(detections[:, t]["score"] > 0)
+        x1, y1, x2, y2 = detections[seen[0], t]["box"]
+        print(
+            f"  face {t}: in {len(seen)} frames, first at {timestamp(seen[0])} "
+            f"around x={(x1 + x2) // 2} y={(y1 + y2) // 2}"
+        )
 
-        y1 = max(0, rect[1] - pady1)
-        y2 = min(image.shape[0], rect[3] + pady2)
-        x1 = max(0, rect[0] - padx1)
-        x2 = min(image.shape[1], rect[2] + padx2)
+    track_ids = args.track_faces or list(range(len(args.track_audio)))
+    faces, has_face = [], []
+    for audio_path, t in zip(args.track_audio, track_ids):
+        if t not in in_frames:
+            print(f"No face {t} for {audio_path}, it won't be lip synced")
+            track = np.zeros(len(images), dtype=DETECTION_DTYPE)
+        else:
+            track = detections[:, t]
+        track_boxes, track_has_face = face_boxes(track, images[0])
+        faces.append(track_boxes)
+        has_face.append(track_has_face)
+
+    report_faceless(np.any(has_face, axis=0))
+    return np.array(faces), np.array(has_face)
+
+
+def cached_face_tracks(images):
+    # every face in every image as an (N, faces) array of DETECTION_DTYPE records, the
+    # second axis being the track id. Cached like cached_face_rect, but only whole videos
+    face_batch_size, scale = face_detection_settings(images[0].shape)
+
+    cache = None
+    if args.face_cache_size > 0:
+        cache = FaceCache(args.face_cache_dir, args.face_cache_size)
+        params = dict(face_detection_params(scale), max_faces=args.max_faces)
+        key = cache.key(args.face, params)
+        cached = None if args.redo_face_detection else cache.load(key)
+        if cached is not None and cached.ndim == 2 and len(cached) >= len(images):
+            print("Using face detection data from a previous run on this video")
+            return cached[: len(images)]
+
+    scene_cuts = None
+    if args.scene_cut_threshold > 0:
+        scene_cuts = SceneCutDetector(args.scene_cut_threshold)
+    detect, face_batch_size, pool = face_detector(face_batch_size, scale, all_faces=True)
+    tracker = FaceTracker()
+    frames = []  # (cut, {track id: face}) of every image
+    try:
+        for start in tqdm(
+            range(0, len(images), face_batch_size),
+            desc="detecting faces in every frame",
+            ncols=100,
+        ):
+            batch = images[start : start + face_batch_size]
+            cuts = scene_cuts.find(batch) if scene_cuts is not None else [False] * len(batch)
+            for cut, faces in zip(cuts, detect(batch)):
+                faces = faces[: args.max_faces]
+                ids = tracker.update([face[0] for face in faces])
+                frames.append((cut, dict(zip(ids, faces))))
+    finally:
+        if pool is not None:
+            pool.close()
+
+    detections = np.zeros((len(frames), len(tracker.boxes)), dtype=DETECTION_DTYPE)
+    for i, (cut, faces) in enumerate(frames):
+        detections[i]["cut"] = cut
+        for t, face in faces.items():
+            detections[i, t] = to_detections([face], [cut])[0]
+
+    if cache is not None:
+        cache.save(key, detections)
+    return detections
+
+
+def face_detect_stream(frames):
+    # streaming version of face_detect: yields (frame, face) as soon as the gap filling and
+    # box filter allow it, so only the frames inside their lookahead windows are alive.
+    # face is a face_boxes row, or None for frames that are left untouched
+    gaps = GapFillStream(args.missing_face, args.max_face_gap)
+    box_filter = None
+    if str(args.nosmooth) == "False":
+        box_filter = BoxFilterStream(**box_filter_params())
+    gap_pending = deque()  # (frame, cut) waiting for their box to be filled in
+    filter_pending = deque()  # frames waiting for their smoothed box
+    has_face = []
+    faceless_start = None  # first frame of the span without a face being streamed
+
+    def mark(found):
+        # reports every span without a face as soon as it ends, there's no list up front here
+        nonlocal faceless_start
+        if not found and faceless_start is None:
+            faceless_start = len(has_face)
+        elif found and faceless_start is not None:
+            tqdm.write(f"No face, left unchanged: {timestamp(faceless_start)} - {timestamp(len(has_face))}")
+            faceless_start = None
+        has_face.append(found)
+
+    def smoothed(image, cut, face):
+        if box_filter is None:
+            yield image, face
+            return
+        if cut or face is None:
+            # finish the previous shot, the filter starts over after a cut or untouched frames
+            for f in box_filter.flush():
+                yield filter_pending.popleft(), f
+        if face is None:
+            yield image, None
+            return
+        filter_pending.append(image)
+        for f in box_filter.push(face):
+            yield filter_pending.popleft(), f
+
+    for image, detection in cached_face_rect(frames):
+        box = None
+        if detection["score"] > 0:
+            box = np.concatenate([pad_box(image, detection["box"]), detection["landmarks"].reshape(10)])
+        cut = bool(detection["cut"])
+        gap_pending.append((image, cut))
+        for filled in gaps.push(box, cut):
+            mark(filled is not None)
+            yield from smoothed(*gap_pending.popleft(), filled)
+
+    for filled in gaps.flush():
+        mark(filled is not None)
+        yield from smoothed(*gap_pending.popleft(), filled)
+    if box_filter is not None:
+        for f in box_filter.flush():
+            yield filter_pending.popleft(), f
+    if faceless_start == 0:
+        tqdm.write("No face was found in the video, it was left unchanged")
+    elif faceless_start is not None:
+        tqdm.write(f"No face, left unchanged: {timestamp(faceless_start)} - {timestamp(len(has_face))}")
+
+
+def report_faceless(has_face):
+    # the spans without a face skip Wav2Lip and are copied from the input as they are
+    has_face = np.asarray(has_face, dtype=bool)
+    faceless = spans(~has_face)
+    if not faceless:
+        return
+    if not has_face.any():
+        print("\nNo face was found in the video, it will be left unchanged")
+        return
+    print(f"\n{len(has_face) - np.count_nonzero(has_face)} frames without a face will be left unchanged:")
+    for start, end in faceless:
+        print(f"  {timestamp(start)} - {timestamp(end)}")
+
+
+def timestamp(frame):
+    seconds = frame / args.fps
+    return f"{int(seconds // 60):02d}:{seconds % 60:05.2f}"
+
+
+def box_filter_params():
+    return dict(
+        method=args.box_filter,
+        window=args.smooth_window,
+        alpha=args.ema_alpha,
+        fps=args.fps,
+        min_cutoff=args.one_euro_min_cutoff,
+        beta=args.one_euro_beta,
+    )
 
-        results.append([x1, y1, x2, y2])
 
+def batch_samples(samples):
+    # samples yields (frame, crops) for every output frame, with a (face, coords, landmarks, mel)
+    # crop for every face to lip sync in the frame. The crops of a frame always go in the same batch,
+    # and coords_batch has the list of (coords, landmarks) of every frame. Frames without crops are
+    # left untouched, they go in batches of their own with no img_batch
+    img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+    untouched = []
+
+    for frame, crops in samples:
+        if not crops:
+            if len(img_batch) > 0:
+                yield prepare_batch(img_batch, mel_batch) + (frame_batch, coords_batch)
+                img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+            untouched.append(frame)
+            if len(untouched) >= args.wav2lip_batch_size:
+                yield None, None, untouched, None
+                untouched = []
+            continue
+
+        if len(untouched) > 0:
+            yield None, None, untouched, None
+            untouched = []
+
+        if len(img_batch) > 0 and len(img_batch) + len(crops) > args.wav2lip_batch_size:
+            yield prepare_batch(img_batch, mel_batch) + (frame_batch, coords_batch)
+            img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
 
-    boxes = np.array(results)
-    if str(args.nosmooth) == "False":
-        boxes = get_smoothened_boxes(boxes, T=5)
-    results = [
-        [image[y1:y2, x1:x2], (y1, y2, x1, x2)]
-        for image, (x1, y1, x2, y2) in zip(images, boxes)
-    ]
+        for face, _, _, m in crops:
+            img_batch.append(cv2.resize(face, (args.img_size, args.img_size)))
+            mel_batch.append(m)
+        frame_batch.append(frame)
+        coords_batch.append([(coords, landmarks) for _, coords, landmarks, _ in crops])
 
-    # Save results to file
-    with open(results_file, "wb") as f:
-        pickle.dump(results, f)
+        if len(img_batch) >= args.wav2lip_batch_size:
+            yield prepare_batch(img_batch, mel_batch) + (frame_batch, coords_batch)
+            img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
 
-    return results
+    if len(img_batch) > 0:
+        yield prepare_batch(img_batch, mel_batch) + (frame_batch, coords_batch)
+    if len(untouched) > 0:
+        yield None, None, untouched, None
 
 
-def datagen(frames, mels):
-    img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+def prepare_batch(img_batch, mel_batch):
+    img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+
+    img_masked = img_batch.copy()
+    img_masked[:, args.img_size // 2 :] = 0
+
+    img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.0
+    mel_batch = np.reshape(
+        mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1]
+    )
+
+    return img_batch, mel_batch
+
+
+def datagen(frames, track_mels):
+    # track_mels has the mel chunks of every speaker, just the one unless --track_audio is used
     print("\r" + " " * 100, end="\r")
-    if args.box[0] == -1:
+    if args.track_audio:
+        faces, has_face = face_detect_tracks(frames[:1] if args.static else frames)
+    elif args.box[0] == -1:
         if not args.static:
-            face_det_results = face_detect(frames)  # BGR2RGB for CNN face detection
+            faces, has_face = face_detect(frames)  # BGR2RGB for CNN face detection
         else:
-            face_det_results = face_detect([frames[0]])
+            faces, has_face = face_detect([frames[0]])
+        faces, has_face = [faces], [has_face]
     else:
         print("Using the specified bounding box instead of face detection...")
-        y1, y2, x1, x2 = args.box
-        face_det_results = [[f[y1:y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
-
-    for i, m in enumerate(mels):
-        idx = 0 if args.static else i % len(frames)
-        frame_to_save = frames[idx].copy()
-        face, coords = face_det_results[idx].copy()
-
-        face = cv2.resize(face, (args.img_size, args.img_size))
+        faces = [box_faces(len(frames))]
+        has_face = [np.ones(len(frames), dtype=bool)]
+
+    def samples():
+        for i in range(len(track_mels[0])):
+            idx = 0 if args.static else i % len(frames)
+            tracks = [t for t in range(len(faces)) if has_face[t][idx]]
+            if not tracks:
+                yield frames[idx], []  # written out as it is, no copy needed
+                continue
+            frame = frames[idx].copy()
+            crops = [face_crop(frame, faces[t][idx]) + (track_mels[t][i],) for t in tracks]
+            yield frame, crops
+
+    yield from batch_samples(samples())
+
+
+def face_samples(detections, mels):
+    # (frame, crops) for batch_samples from (frame, face) pairs, face None leaves the frame untouched
+    for m, (frame, face) in zip(mels, detections):
+        if face is None:
+            yield frame, []
+            continue
+        yield frame, [face_crop(frame, face) + (m,)]
+
+
+def open_writer(fps, frame_size):
+    if args.encoder == "ffmpeg" and str(args.preview_settings) == "False":
+        # encodes and muxes the audio in one pass, straight to the final file
+        return FFmpegWriter(
+            args.outfile,
+            fps,
+            frame_size,
+            audio=args.audio,
+            preset=args.x264_preset,
+            crf=args.x264_crf,
+            threads=args.encoder_threads,
+        )
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    return cv2.VideoWriter("temp/result.mp4", fourcc, fps, frame_size)
 
-        img_batch.append(face)
-        mel_batch.append(m)
-        frame_batch.append(frame_to_save)
-        coords_batch.append(coords)
 
-        if len(img_batch) >= args.wav2lip_batch_size:
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+def input_frames(max_frames=None):
+    out_height = args.out_height if args.fullres != 1 else None
+    if args.decoder == "ffmpeg":
+        return read_frames_ffmpeg(
+            args.face, out_height, args.rotate, args.crop, max_frames
+        )
+    return read_frames(args.face, out_height, args.rotate, args.crop, max_frames)
 
-            img_masked = img_batch.copy()
-            img_masked[:, args.img_size // 2 :] = 0
 
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.0
-            mel_batch = np.reshape(
-                mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1]
-            )
+def datagen_stream(mels):
+    # like datagen, but frames are decoded and face detected as they are needed
+    # instead of being held in memory for the whole video
+    print("\r" + " " * 100, end="\r")
 
-            yield img_batch, mel_batch, frame_batch, coords_batch
-            img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+    def samples():
+        frames = input_frames(len(mels))
+        if args.pipeline:
+            frames = prefetch(frames, args.queue_size * args.wav2lip_batch_size)
+        if args.box[0] == -1:
+            detections = face_detect_stream(frames)
+            if args.pipeline:
+                detections = prefetch(detections, args.queue_size * args.wav2lip_batch_size)
+        else:
+            print("Using the specified bounding box instead of face detection...")
+            detections = zip(frames, repeat(box_faces(1)[0]))
 
-    if len(img_batch) > 0:
-        img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+        # only the boxes are kept so the video can be looped if the audio is longer
+        all_faces = []
+        for frame, face in detections:
+            all_faces.append(face)
+            yield frame, face
 
-        img_masked = img_batch.copy()
-        img_masked[:, args.img_size // 2 :] = 0
+        if not all_faces:
+            raise ValueError("Could not read any frames from " + args.face)
 
-        img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.0
-        mel_batch = np.reshape(
-            mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1]
-        )
+        while 1:
+            yield from zip(input_frames(), all_faces)
 
-        yield img_batch, mel_batch, frame_batch, coords_batch
+    yield from batch_samples(face_samples(samples(), mels))
 
 
 mel_step_size = 16
@@ -581,69 +1140,103 @@ def _load(checkpoint_path):
     return checkpoint
 
 
-def main():
-    args.img_size = 96
-    frame_number = 11
+def infer_batch(batch):
+    img_batch, mel_batch, frames, coords = batch
+    if img_batch is None:
+        return None, frames, None  # frames without a face skip the model
 
-    if os.path.isfile(args.face) and args.face.split(".")[1] in ["jpg", "png", "jpeg"]:
-        args.static = True
+    if args.channels_last:
+        # the NHWC batch already is channels last in memory, permuting only changes the view
+        img_batch = torch.from_numpy(img_batch.astype(np.float32)).permute(0, 3, 1, 2).to(device)
+    else:
+        img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
+    mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
 
-    if not os.path.isfile(args.face):
-        raise ValueError("--face argument must be a valid path to video/image file")
+    with torch.no_grad(), autocast(args.precision, device):
+        pred = model(mel_batch, img_batch)
 
-    elif args.face.split(".")[1] in ["jpg", "png", "jpeg"]:
-        full_frames = [cv2.imread(args.face)]
-        fps = args.fps
+    # a channels last prediction comes out of this transpose contiguous
+    pred = pred.float().cpu().numpy().transpose(0, 2, 3, 1) * 255.0
 
-    else:
-        if args.fullres != 1:
-            print("Resizing video...")
-        video_stream = cv2.VideoCapture(args.face)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
+    return pred, frames, coords
 
-        full_frames = []
-        while 1:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break
 
-            if args.fullres != 1:
-                aspect_ratio = frame.shape[1] / frame.shape[0]
-                frame = cv2.resize(
-                    frame, (int(args.out_height * aspect_ratio), args.out_height)
-                )
+def blend_batch(batch, run_params=None, mask_engine=None, index=None):
+    # pastes the predicted faces back into their frames, returns a (face, frame) pair per frame,
+    # index is the batch's number in the video when several threads blend batches at once
+    try:
+        return paste_batch(batch, run_params, mask_engine, index)
+    finally:
+        if mask_engine is not None:
+            mask_engine.finish(index)  # even a batch without faces, so the next one's turn comes
 
-            if args.rotate:
-                frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
 
-            y1, y2, x1, x2 = args.crop
-            if x2 == -1:
-                x2 = frame.shape[1]
-            if y2 == -1:
-                y2 = frame.shape[0]
+def paste_batch(batch, run_params, mask_engine, index):
+    pred, frames, coords = batch
+    if pred is None:
+        return [(None, f) for f in frames]
+    preds = iter(pred)
+    crops = []  # (frame, coords, face) of every predicted face
 
-            frame = frame[y1:y2, x1:x2]
+    for f, frame_coords in zip(frames, coords):
+        # cv2.imwrite('temp/f.jpg', f)
 
-            full_frames.append(frame)
+        if (
+            str(args.debug_mask) == "True"
+        ):  # makes the background black & white so you can see the mask better
+            cv2.cvtColor(cv2.cvtColor(f, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR, f)
 
-    if not args.audio.endswith(".wav"):
-        print("Converting audio to .wav")
-        subprocess.check_call(
-            [
-                "ffmpeg",
-                "-y",
-                "-loglevel",
-                "error",
-                "-i",
-                args.audio,
-                "temp/temp.wav",
-            ]
-        )
-        args.audio = "temp/temp.wav"
+        for (y1, y2, x1, x2), landmarks in frame_coords:
+            p = cv2.resize(next(preds).astype(np.uint8), (x2 - x1, y2 - y1))
 
-    print("analysing audio...")
-    wav = audio.load_wav(args.audio, 16000)
+            if args.quality == "Enhanced":
+                with sr_lock:  # GFPGANer keeps per call state so can't be shared between threads
+                    p = upscale(p, run_params)
+            if landmarks is not None:
+                landmarks = landmarks - (x1, y1)  # in the face's coordinates
+            crops.append((f, (y1, y2, x1, x2), p, landmarks))
+
+    if mask_engine is not None:
+        # the faces that got a mask are blended all at once
+        masks = mask_engine.compute([p for _, _, p, _ in crops], [l for _, _, _, l in crops], index)
+        masked = [i for i, mask in enumerate(masks) if mask is not None]
+        faces, backgrounds = [], []
+        for i in masked:
+            f, (y1, y2, x1, x2), p, _ = crops[i]
+            faces.append(p)
+            backgrounds.append(f[y1:y2, x1:x2])
+        blended = alpha_blend_batch(faces, backgrounds, [masks[i] for i in masked])
+        for i, p in zip(masked, blended):
+            crops[i] = crops[i][:2] + (p, None)
+
+    results = []
+    for f, (y1, y2, x1, x2), p, _ in crops:
+        f[y1:y2, x1:x2] = p
+        if not results or results[-1][1] is not f:
+            results.append((p, f))
+        else:
+            results[-1] = (p, f)
+
+    return results
+
+
+def convert_to_wav(path, wav_path):
+    subprocess.check_call(
+        [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-i",
+            path,
+            wav_path,
+        ]
+    )
+    return wav_path
+
+
+def get_mel_chunks(wav, fps):
+    # the mel spectrogram window of every video frame
     mel = audio.melspectrogram(wav)
 
     if np.isnan(mel.reshape(-1)).sum() > 0:
@@ -663,80 +1256,147 @@ def main():
         mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
         i += 1
 
-    full_frames = full_frames[: len(mel_chunks)]
-    if str(args.preview_settings) == "True":
-        full_frames = [full_frames[0]]
-        mel_chunks = [mel_chunks[0]]
-    print(str(len(full_frames)) + " frames to process")
-    batch_size = args.wav2lip_batch_size
-    if str(args.preview_settings) == "True":
-        gen = datagen(full_frames, mel_chunks)
-    else:
-        gen = datagen(full_frames.copy(), mel_chunks)
+    return mel_chunks
 
-    for i, (img_batch, mel_batch, frames, coords) in enumerate(
-        tqdm(
-            gen,
-            total=int(np.ceil(float(len(mel_chunks)) / batch_size)),
-            desc="Processing Wav2Lip",
-            ncols=100,
-        )
-    ):
-        if i == 0:
-            if not args.quality == "Fast":
-                print(
-                    f"mask size: {args.mask_dilation}, feathering: {args.mask_feathering}"
-                )
-                if not args.quality == "Improved":
-                    print("Loading", args.sr_model)
-                    run_params = load_sr()
-
-            print("Starting...")
-            frame_h, frame_w = full_frames[0].shape[:-1]
-            fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-            out = cv2.VideoWriter("temp/result.mp4", fourcc, fps, (frame_w, frame_h))
 
-        img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-        mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+def main():
+    args.img_size = 96
+    frame_number = 11
 
-        with torch.no_grad():
-            pred = model(mel_batch, img_batch)
+    if os.path.isfile(args.face) and args.face.split(".")[1] in ["jpg", "png", "jpeg"]:
+        args.static = True
 
-        pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.0
+    # preview and still images only ever use one frame so there is nothing to stream
+    streaming = (
+        args.streaming
+        and not args.static
+        and str(args.preview_settings) == "False"
+    )
 
-        for p, f, c in zip(pred, frames, coords):
-            # cv2.imwrite('temp/f.jpg', f)
+    if not os.path.isfile(args.face):
+        raise ValueError("--face argument must be a valid path to video/image file")
 
-            y1, y2, x1, x2 = c
+    elif args.face.split(".")[1] in ["jpg", "png", "jpeg"]:
+        fps = args.fps
 
-            if (
-                str(args.debug_mask) == "True"
-            ):  # makes the background black & white so you can see the mask better
-                f = cv2.cvtColor(f, cv2.COLOR_BGR2GRAY)
-                f = cv2.cvtColor(f, cv2.COLOR_GRAY2BGR)
+    else:
+        fps = get_fps(args.face)
+    args.fps = fps  # used by the one_euro box filter and the faceless span report
 
-            p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-            cf = f[y1:y2, x1:x2]
+    if not args.audio.endswith(".wav"):
+        print("Converting audio to .wav")
+        args.audio = convert_to_wav(args.audio, "temp/temp.wav")
 
-            if args.quality == "Enhanced":
-                p = upscale(p, run_params)
+    print("analysing audio...")
+    wav = audio.load_wav(args.audio, 16000)
+    mel_chunks = get_mel_chunks(wav, fps)
 
-            if args.quality in ["Enhanced", "Improved"]:
-                if str(args.mouth_tracking) == "True":
-                    p, last_mask = create_tracked_mask(p, cf)
-                else:
-                    p, last_mask = create_mask(p, cf)
+    # each speaker's audio drives the lips of one face, the output keeps --audio as its sound
+    track_mels = [mel_chunks]
+    if args.track_audio:
+        if args.track_faces and len(args.track_faces) != len(args.track_audio):
+            raise ValueError(
+                f"--track_faces has {len(args.track_faces)} face ids for {len(args.track_audio)} --track_audio "
+                "files, give one face id per file"
+            )
+        if streaming:
+            print("--track_audio can't be used with --streaming, the video will be loaded into memory")
+            streaming = False
+        track_mels = []
+        for i, path in enumerate(args.track_audio):
+            if not path.endswith(".wav"):
+                path = convert_to_wav(path, f"temp/track{i}.wav")
+            # silence past the end of a shorter track keeps its face's mouth closed
+            track_wav = audio.load_wav(path, 16000)[: len(wav)]
+            track_wav = np.pad(track_wav, (0, len(wav) - len(track_wav)))
+            track_mels.append(get_mel_chunks(track_wav, fps))
+
+    # only decode the frames that will actually be used
+    if str(args.preview_settings) == "True":
+        mel_chunks = [mel_chunks[0]]
+        track_mels = [mels[:1] for mels in track_mels]
 
-            f[y1:y2, x1:x2] = p
+    if args.face.split(".")[1] in ["jpg", "png", "jpeg"]:
+        full_frames = [cv2.imread(args.face)]
+
+    elif not streaming:
+        if args.fullres != 1:
+            print("Resizing video...")
+        full_frames = list(input_frames(len(mel_chunks)))
+
+    batch_size = args.wav2lip_batch_size
+    if streaming:
+        print(str(len(mel_chunks)) + " frames to process")
+        gen = datagen_stream(mel_chunks)
+    else:
+        print(str(len(full_frames)) + " frames to process")
+        if str(args.preview_settings) == "True":
+            gen = datagen(full_frames, track_mels)
+        else:
+            gen = datagen(full_frames.copy(), track_mels)
+
+    run_params = None
+    if not args.quality == "Fast":
+        print(
+            f"mask size: {args.mask_dilation}, feathering: {args.mask_feathering}"
+        )
+        if not args.quality == "Improved":
+            print("Loading", args.sr_model)
+            run_params = load_sr()
+
+    mask_engine = None
+    if args.quality in ["Enhanced", "Improved"]:
+        mask_engine = MaskEngine(
+            predictor,
+            mouth_detector,
+            tracking=str(args.mouth_tracking) == "True",
+            landmarks=args.mouth_landmarks,
+            dilation=args.mask_dilation,
+            feathering=args.mask_feathering,
+            pads=args.pads,
+            workers=args.landmark_workers,
+        )
+
+    blend = partial(blend_batch, run_params=run_params, mask_engine=mask_engine)
+    if args.pipeline:
+        blend_workers = args.blend_workers
+        if str(args.mouth_tracking) == "True" and blend_workers > 1:
+            # the tracked mask falls back to the previous frame's mask so has to run in order
+            print("mouth_tracking needs frames to be blended in order, using 1 blend worker")
+            blend_workers = 1
+
+        # each stage runs in its own thread(s), connected by queues of at most queue_size batches
+        gen = prefetch(gen, args.queue_size)
+        gen = ordered_map(infer_batch, gen, args.model_workers, args.queue_size)
+        # numbered so the batches take turns until the untracked mask is found, which keeps it the first face's
+        gen = ordered_map(
+            lambda numbered: blend(numbered[1], index=numbered[0]), enumerate(gen), blend_workers, args.queue_size
+        )
+    else:
+        gen = map(blend, map(infer_batch, gen))
+
+    print("Starting...")
+    out = None
+    for results in tqdm(
+        gen,
+        total=int(np.ceil(float(len(mel_chunks)) / batch_size)),
+        desc="Processing Wav2Lip",
+        ncols=100,
+    ):
+        for p, f in results:
+            if out is None:
+                frame_h, frame_w = f.shape[:-1]
+                out = open_writer(fps, (frame_w, frame_h))
 
             if not g_colab:
                 # Display the frame
-                if preview_window == "Face":
+                if preview_window == "Face" and p is not None:
                     cv2.imshow("face preview - press Q to abort", p)
                 elif preview_window == "Full":
                     cv2.imshow("full preview - press Q to abort", f)
                 elif preview_window == "Both":
-                    cv2.imshow("face preview - press Q to abort", p)
+                    if p is not None:
+                        cv2.imshow("face preview - press Q to abort", p)
                     cv2.imshow("full preview - press Q to abort", f)
 
                 key = cv2.waitKey(1) & 0xFF
@@ -756,9 +1416,13 @@ def main():
     # Close the window(s) when done
     cv2.destroyAllWindows()
 
-    out.release()
+    if mask_engine is not None:
+        mask_engine.close()
+
+    if out is not None:
+        out.release()
 
-    if str(args.preview_settings) == "False":
+    if str(args.preview_settings) == "False" and args.encoder == "opencv":
         print("converting to final video")
 
         subprocess.check_call([
@@ -776,6 +1440,8 @@ def main():
         ])
 
 if __name__ == "__main__":
+    if device == 'cpu':
+        print('Warning: No GPU detected so inference will be done on the CPU which is VERY SLOW!')
     args = parser.parse_args()
     do_load(args.checkpoint_path)
     main()
@@ -0,0 +1,309 @@
+import math
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import cv2
+import numpy as np
+
+
+def alpha_blend(fg, bg, alpha):
+    """Blend fg over bg, alpha being a uint8 (h, w) mask where 255 is all fg.
+
+    The same result as pasting with PIL give or take a rounding step, without converting
+    the images to anything.
+    """
+    weights = alpha.astype(np.float32) * (1 / 255)
+    return cv2.blendLinear(fg, bg, weights, 1 - weights)
+
+
+def alpha_blend_batch(fgs, bgs, alphas):
+    """alpha_blend for the lists of faces, backgrounds and masks of a whole batch.
+
+    Each face is blended on its own: stacking same size faces into one tall image and
+    blending that in a single call measured slower, it no longer fits in the CPU cache.
+    """
+    return [alpha_blend(fg, bg, alpha) for fg, bg, alpha in zip(fgs, bgs, alphas)]
+
+
+def feathered_mouth_mask(shape, mouth_points, dilation, feathering, always_blur=False):
+    """uint8 mask of the given shape: the mouth polygon dilated, thresholded and blurred.
+
+    The dilation kernel and the blur are fractions (dilation, feathering) of the mouth's
+    size. Without always_blur a feathering of 0 leaves the edge hard. With it the
+    feathering is rounded up to an odd number first, as mouth tracking has always done.
+    """
+    mouth_points = np.asarray(mouth_points, dtype=np.int32)
+    x, y, w, h = cv2.boundingRect(mouth_points)
+
+    # Create binary mask for mouth and dilate it
+    kernel_size = int(max(w, h) * dilation)
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    cv2.fillConvexPoly(mask, mouth_points, 255)
+    dilated_mask = cv2.dilate(mask, kernel)
+
+    # Normalized distance transform of the dilated mask, thresholded back to a binary mask
+    dist_transform = cv2.distanceTransform(dilated_mask, cv2.DIST_L2, 5)
+    cv2.normalize(dist_transform, dist_transform, 0, 255, cv2.NORM_MINMAX)
+    _, masked_diff = cv2.threshold(dist_transform, 50, 255, cv2.THRESH_BINARY)
+    masked_diff = masked_diff.astype(np.uint8)
+
+    if always_blur:
+        if feathering % 2 == 0:
+            feathering += 1
+    elif feathering == 0:
+        return masked_diff
+    blur = feather_size(w, h, feathering)
+    return cv2.GaussianBlur(masked_diff, (blur, blur), 0)
+
+
+def feather_size(w, h, feathering):
+    # blur size as a fraction of the mouth size, always odd
+    blur = int(max(w, h) * feathering)
+    if blur % 2 == 0:
+        blur += 1
+    return blur
+
+
+class MaskTemplates:
+    """Feathered mouth masks built once per mouth size and place and moved onto every frame's mouth.
+
+    Building a mask (dilate, distance transform, a blur as big as the mouth) costs far more
+    than warping one. A template is a mask built for a whole face crop, like
+    feathered_mouth_mask, so it's clipped at the edges of the crop the same way. Any later
+    mouth with the width, height and crop size in the same steps of bucket (5%), at the same
+    place in its crop to within position_step of the crop's size, gets the template scaled
+    and translated onto its bounding box. At most max_templates are kept, the least
+    recently used are dropped.
+    """
+
+    def __init__(
+        self, dilation, feathering, always_blur=False, bucket=1.05, position_step=0.02, max_templates=64
+    ):
+        self.dilation = dilation
+        self.feathering = feathering
+        self.always_blur = always_blur
+        self.bucket = bucket
+        self.position_step = position_step
+        self.max_templates = max_templates
+        self.templates = OrderedDict()
+
+    def mask(self, shape, mouth_points):
+        """Feathered mask of the given shape for mouth_points, like feathered_mouth_mask."""
+        mouth_points = np.asarray(mouth_points, dtype=np.float64).round()
+        height, width = shape[:2]
+        x, y, w, h = cv2.boundingRect(mouth_points.astype(np.int32))
+        key = (
+            self._bucket(w),
+            self._bucket(h),
+            self._bucket(width),
+            self._bucket(height),
+            round(x / width / self.position_step),
+            round(y / height / self.position_step),
+        )
+        template = self.templates.get(key)
+        if template is None:
+            image = feathered_mouth_mask(shape, mouth_points, self.dilation, self.feathering, self.always_blur)
+            self.templates[key] = (image, (x, y, w, h))
+            if len(self.templates) > self.max_templates:
+                self.templates.popitem(last=False)
+            return image
+        self.templates.move_to_end(key)
+
+        image, (tx, ty, tw, th) = template
+        if (tx, ty, tw, th) == (x, y, w, h) and image.shape == (height, width):
+            return image
+        sx, sy = w / max(tw, 1), h / max(th, 1)
+        warp = np.array([[sx, 0, x - tx * sx], [0, sy, y - ty * sy]])
+        # the template is clipped at the crop's edges like the mask, the edge carries on past them
+        return cv2.warpAffine(image, warp, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    def _bucket(self, size):
+        return round(math.log(max(size, 1)) / math.log(self.bucket))
+
+
+def mouth_from_landmarks(landmarks, points=20):
+    """Mouth polygon from the 5 RetinaFace landmarks (eyes, nose, mouth corners).
+
+    An ellipse through the mouth corners, reaching 40% of the way up to the nose and 60%
+    of that distance below the corners, which covers the lips whether the mouth is open or not.
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    nose, left, right = landmarks[2], landmarks[3], landmarks[4]
+    center = (left + right) / 2
+    across = (right - left) / 2
+    # the direction from the nose towards the mouth, at right angles to the corners
+    down = np.array([-across[1], across[0]])
+    down /= max(np.linalg.norm(down), 1e-6)
+    if np.dot(down, center - nose) < 0:
+        down = -down
+    reach = max(np.dot(center - nose, down), 1.0)
+
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    # sin is positive on the lower half of the ellipse
+    heights = np.where(np.sin(angles) > 0, 0.6, 0.4) * reach * np.sin(angles)
+    return center + np.cos(angles)[:, None] * across + heights[:, None] * down
+
+
+def shape_mouth(shape):
+    # the 20 mouth points (48 to 67) of dlib's 68 landmarks as an array, the other 48 aren't read
+    parts = shape.parts()
+    coordinates = chain.from_iterable((parts[i].x, parts[i].y) for i in range(48, 68))
+    points = np.fromiter(coordinates, dtype=np.int64, count=40)
+    return points.reshape(20, 2)
+
+
+class MaskEngine:
+    """Mouth masks for the predicted faces of one video, with everything that carries over between frames.
+
+    predictor is dlib's 68 point shape predictor and detector its HOG face detector, both
+    only used to find mouths and safe to share between engines. landmarks is where the
+    mouth comes from: hog finds the face again in the prediction, dlib takes the crop
+    minus pads as the face and retinaface builds the mouth from the detection landmarks.
+    Without tracking the first mask found is reused for every face, with it the mouth is
+    found in every face and a face without one gets the last mouth found. Masks must be
+    computed in frame order, one batch at a time, so create one engine per video.
+    """
+
+    def __init__(
+        self,
+        predictor,
+        detector=None,
+        tracking=False,
+        landmarks="hog",
+        dilation=2.5,
+        feathering=2,
+        pads=(0, 10, 0, 0),
+        workers=4,
+    ):
+        self.predictor = predictor
+        self.detector = detector
+        self.tracking = tracking
+        self.landmarks = landmarks
+        self.dilation = dilation
+        self.feathering = feathering
+        self.pads = pads
+        self.workers = workers
+        self.pool = None
+        self.local = threading.local()
+        # batches blended on several threads take turns until the first mask is found
+        self.turn = threading.Condition()
+        self.next_batch = 0
+        self.finished = set()
+        self.templates = MaskTemplates(dilation, feathering, always_blur=True)
+        self.reset()
+
+    def reset(self):
+        # forget the mask and mouth of the previous faces, eg: to start another video
+        self.last_mask = self.last_mouth = None
+        self.next_batch = 0
+        self.finished = set()
+
+    def find_mouth(self, img, landmarks=None):
+        """The mouth polygon in the face img, or None if it can't be found.
+
+        landmarks are the face's RetinaFace landmarks in img's coordinates, if known.
+        """
+        if self.landmarks == "retinaface" and landmarks is not None:
+            return mouth_from_landmarks(landmarks)
+
+        # dlib wants RGB
+        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if self.landmarks == "hog":
+            faces = self._detector()(rgb)
+            if len(faces) == 0:
+                return None
+            face = faces[0]
+        else:
+            import dlib
+
+            # the face was already found by face detection, it's the crop without the padding
+            pady1, pady2, padx1, padx2 = self.pads
+            height, width = img.shape[:2]
+            face = dlib.rectangle(
+                min(padx1, width - 1), min(pady1, height - 1), max(0, width - 1 - padx2), max(0, height - 1 - pady2)
+            )
+        return shape_mouth(self.predictor(rgb, face))
+
+    def _detector(self):
+        # dlib's HOG detector keeps the image it scans in itself, so every thread (landmark or
+        # blend worker) gets its own copy. The shape predictor has no such state and is shared
+        if not hasattr(self.local, "detector"):
+            self.local.detector = pickle.loads(pickle.dumps(self.detector))
+        return self.local.detector
+
+    def find_mouths(self, imgs, landmarks):
+        """find_mouth for every face at once on the engine's threads, dlib releases the GIL."""
+        if self.workers <= 1 or len(imgs) <= 1:
+            return [self.find_mouth(img, l) for img, l in zip(imgs, landmarks)]
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        return list(self.pool.map(self.find_mouth, imgs, landmarks))
+
+    def compute(self, preds, landmarks=None, index=None):
+        """uint8 masks the size of every predicted face in preds, None for a face with no mouth to mask.
+
+        landmarks holds each face's RetinaFace landmarks in its own coordinates, or None.
+        index is the batch's number in the video when several threads compute batches at
+        once, every batch must then be passed to finish() too. Without tracking, the batches
+        wait for their turn until the first mask is found, so it's always the same face's.
+        """
+        if landmarks is None:
+            landmarks = [None] * len(preds)
+        if self.tracking:
+            # the mouths are found in parallel, the masks in order since a face
+            # without a mouth gets the previous face's
+            mouths = self.find_mouths(preds, landmarks)
+            return [self._tracked_mask(p, mouth) for p, mouth in zip(preds, mouths)]
+        if index is None or self.last_mask is not None:
+            return [self._mask(p, l) for p, l in zip(preds, landmarks)]
+        with self.turn:
+            self.turn.wait_for(lambda: self.last_mask is not None or self.next_batch == index)
+            return [self._mask(p, l) for p, l in zip(preds, landmarks)]
+
+    def finish(self, index):
+        # the batch numbered index is done with, whether it had faces or not
+        if index is None:
+            return
+        with self.turn:
+            self.finished.add(index)
+            while self.next_batch in self.finished:
+                self.finished.remove(self.next_batch)
+                self.next_batch += 1
+            self.turn.notify_all()
+
+    def _tracked_mask(self, img, mouth_points):
+        if mouth_points is None:
+            if self.last_mouth is None:
+                return None
+            # use the last mouth found, scaled to this face
+            mouth_points, size = self.last_mouth
+            mouth_points = mouth_points * (img.shape[1] / size[1], img.shape[0] / size[0])
+        else:
+            self.last_mouth = (mouth_points, img.shape[:2])
+        return self.templates.mask(img.shape, mouth_points)
+
+    def _mask(self, img, landmarks):
+        if self.last_mask is not None:
+            # use the last successful mask
+            return cv2.resize(self.last_mask, (img.shape[1], img.shape[0]))
+
+        mouth_points = self.find_mouth(img, landmarks)
+        if mouth_points is None:
+            return None
+        self.last_mask = feathered_mouth_mask(img.shape, mouth_points.round(), self.dilation, self.feathering)
+        return self.last_mask
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import hashlib
+import inspect
+import os
+import threading
+
+import torch
+
+from face_cache import file_hash
+
+BACKENDS = ["eager", "trace", "compile", "onnxruntime"]
+PRECISIONS = ["fp32", "bf16", "fp16"]
+_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def supported_precision(precision, device):
+    """precision if the device can run the model in it, fp32 if it can't.
+
+    fp16 needs a GPU, bf16 a GPU or a CPU with native bf16 support (AMX or AVX512-BF16,
+    eg: recent Xeons), anywhere else it's emulated and slower than fp32.
+    """
+    device = torch.device(device).type
+    if precision == "fp16" and device != "cuda":
+        return "fp32"
+    if precision == "bf16":
+        if device == "cuda" and not torch.cuda.is_bf16_supported():
+            return "fp32"
+        if device == "cpu" and not _cpu_has_bf16():
+            return "fp32"
+        if device not in ["cuda", "cpu"]:
+            return "fp32"
+    return precision
+
+
+def _cpu_has_bf16():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False  # torch too old to tell
+
+
+def autocast(precision, device):
+    # context that runs the model's convolutions in precision, the rest stays fp32
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=_DTYPES[precision])
+
+
+class CompiledModel:
+    """A model run through one of BACKENDS, built on its first call and reused after that.
+
+    trace records the model with torch.jit.trace, freezes it and saves it in cache_dir,
+    keyed by the checkpoint's content, the torch version, the device, the shape of one
+    sample and variant (anything else that changes the model, eg: fusing). The traced
+    graph doesn't depend on the batch size, so the smaller last batch reuses it. compile
+    uses torch.compile with inductor's caches in cache_dir, so later runs skip most of
+    the compilation. onnxruntime exports the model to ONNX in cache_dir, keyed the same
+    way, and runs it with onnxruntime. With dynamic_size the height and width of the
+    inputs may change from call to call too (eg: a detector). If a backend isn't available
+    or fails, the model runs eagerly. Other attributes are the model's.
+    """
+
+    def __init__(
+        self, model, backend="eager", checkpoint_path=None, cache_dir="model_cache", variant="", dynamic_size=False
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown model backend {backend}, choose from {BACKENDS}")
+        self.model = model
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path
+        self.cache_dir = cache_dir
+        self.variant = variant
+        self.dynamic_size = dynamic_size
+        self.compiled = None if backend != "eager" else model
+        self.lock = threading.Lock()
+
+    def __call__(self, *inputs):
+        if self.compiled is None:
+            with self.lock:  # the model workers all wait for the first one to build it
+                if self.compiled is None:
+                    self.compiled = self._build(inputs)
+        try:
+            return self.compiled(*inputs)
+        except Exception as e:
+            if self.compiled is self.model:
+                raise
+            print(f"\nThe {self.backend} model backend failed ({e}), falling back to eager")
+            self.compiled = self.model
+            return self.model(*inputs)
+
+    def __getattr__(self, name):
+        # eg: RetinaFace's cfg, read by batch_face
+        return getattr(self.__dict__["model"], name)
+
+    def key(self, inputs):
+        h = hashlib.blake2b(digest_size=20)
+        checkpoint = file_hash(self.checkpoint_path) if self.checkpoint_path else ""
+        shapes = [tuple(x.shape[1:2] if self.dynamic_size else x.shape[1:]) for x in inputs]
+        device = inputs[0].device.type
+        h.update(repr((checkpoint, torch.__version__, device, shapes, self.variant, self.backend)).encode())
+        return h.hexdigest()
+
+    def _build(self, inputs):
+        try:
+            if self.backend == "trace":
+                return self._trace(inputs)
+            if self.backend == "onnxruntime":
+                return self._onnxruntime(inputs)
+            return self._compile()
+        except Exception as e:
+            print(f"\nCouldn't build the {self.backend} model backend ({e}), running the model eagerly")
+            return self.model
+
+    def _trace(self, inputs):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, self.key(inputs) + ".pt")
+        if os.path.isfile(path):
+            return torch.jit.load(path, map_location=inputs[0].device)
+
+        print("\nTracing the model, this is only done once for this model and input size")
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(self.model.eval(), inputs))
+        # write to a temporary file first so an interrupted job never leaves a broken entry
+        torch.jit.save(traced, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return traced
+
+    def _compile(self):
+        if not hasattr(torch, "compile"):
+            raise RuntimeError(f"torch.compile needs torch 2.0 or newer, this is {torch.__version__}")
+        # inductor keeps its compiled kernels and graphs here between runs
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(os.path.join(self.cache_dir, "inductor")))
+        import torch._inductor.config as inductor_config
+
+        if hasattr(inductor_config, "fx_graph_cache"):
+            inductor_config.fx_graph_cache = True
+        print("\nCompiling the model, the first batches are slow")
+        # dynamic so the smaller last batch doesn't compile it all over again
+        return torch.compile(self.model, dynamic=True)
+
+    def _onnxruntime(self, inputs):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, self.key(inputs) + ".onnx")
+        if not os.path.isfile(path):
+            print("\nExporting the model to ONNX, this is only done once for this model and input size")
+            export_onnx(self.model, inputs, path + ".tmp", self.dynamic_size)
+            os.replace(path + ".tmp", path)
+        return OnnxModel(path, inputs[0].device)
+
+
+def export_onnx(model, inputs, path, dynamic_size=False):
+    """Export model to ONNX with a dynamic batch size, and dynamic height and width with dynamic_size."""
+    names = [f"input{i}" for i in range(len(inputs))]
+    axes = {0: "batch", 2: "height", 3: "width"} if dynamic_size else {0: "batch"}
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # the torchscript exporter takes dynamic_axes and needs no onnxscript
+    # batch_face detects in inference mode, which the exporter can't trace
+    with torch.inference_mode(False), torch.no_grad():
+        inputs = tuple(x.clone() for x in inputs)
+        torch.onnx.export(
+            model.eval(),
+            inputs,
+            path,
+            input_names=names,
+            dynamic_axes={name: axes for name in names},
+            opset_version=17,
+            **kwargs,
+        )
+
+
+class OnnxModel:
+    """An exported ONNX model run with onnxruntime, called with and returning torch tensors like the model."""
+
+    def __init__(self, path, device="cpu"):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        if torch.device(device).type == "cuda":
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = onnxruntime.InferenceSession(path, options, providers=providers)
+        self.inputs = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        device = inputs[0].device
+        feed = {name: x.detach().cpu().numpy() for name, x in zip(self.inputs, inputs)}
+        outputs = [torch.from_numpy(o).to(device) for o in self.session.run(None, feed)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+if __name__ == "__main__":
+    from models.fused import check_parity, load_checkpoint
+
+    parser = argparse.ArgumentParser(description="Compare a model backend's Wav2Lip outputs with eager PyTorch")
+    parser.add_argument("checkpoint", help="Wav2Lip checkpoint, eg: checkpoints/Wav2Lip.pth")
+    parser.add_argument("--backend", choices=BACKENDS, default="onnxruntime")
+    parser.add_argument("--cache_dir", default="model_cache")
+    parser.add_argument("--detector", help="Also compare a RetinaFace checkpoint, eg: checkpoints/mobilenet.pth")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--atol", type=float, default=1e-4, help="Largest output difference allowed")
+    args = parser.parse_args()
+
+    model = load_checkpoint(args.checkpoint)
+    compiled = CompiledModel(model, args.backend, args.checkpoint, args.cache_dir)
+    difference, ok = check_parity(model, compiled, args.batch_size, args.atol)
+    print(f"Wav2Lip largest output difference: {difference:.2e}")
+
+    if args.detector:
+        from batch_face import RetinaFace
+
+        detector = RetinaFace(gpu_id=-1, model_path=args.detector, network="mobilenet").model.eval()
+        compiled = CompiledModel(detector, args.backend, args.detector, args.cache_dir, dynamic_size=True)
+        for height, width in [(480, 640), (360, 640)]:
+            images = torch.rand(2, 3, height, width) * 255
+            with torch.no_grad():
+                outputs = zip(detector(images), compiled(images))
+                detector_difference = max((a - b).abs().max().item() for a, b in outputs)
+            print(f"RetinaFace {width}x{height} largest output difference: {detector_difference:.2e}")
+            ok = ok and detector_difference <= args.atol
+
+    if not ok:
+        raise SystemExit(f"outputs differ by more than {args.atol}")
@@ -0,0 +1,89 @@
+import argparse
+import copy
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_weights
+
+from .conv import Conv2d, Conv2dTranspose
+from .wav2lip import Wav2Lip
+
+
+class FusedConv2d(nn.Module):
+    """Conv2d or Conv2dTranspose block for inference, with the BatchNorm folded into the conv.
+
+    The residual add and the ReLU are done in place on the conv output, so a block is
+    one conv kernel and at most two cheap elementwise ones instead of four ops.
+    """
+
+    def __init__(self, block):
+        super().__init__()
+        conv, bn = block.conv_block
+        self.conv = copy.deepcopy(conv)
+        transpose = isinstance(conv, nn.ConvTranspose2d)
+        weight, bias = fuse_conv_bn_weights(
+            conv.weight, conv.bias, bn.running_mean, bn.running_var, bn.eps, bn.weight, bn.bias, transpose
+        )
+        self.conv.weight, self.conv.bias = weight, bias
+        self.residual = getattr(block, "residual", False)
+
+    def forward(self, x):
+        out = self.conv(x)
+        if self.residual:
+            out += x
+        return torch.relu_(out)
+
+
+def fuse_model(model):
+    """Copy of a Wav2Lip model in eval mode with every conv block replaced by a FusedConv2d.
+
+    Only valid for inference, the BatchNorm running statistics are baked into the weights.
+    """
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        _fuse_children(model)
+    return model
+
+
+def _fuse_children(module):
+    for name, child in module.named_children():
+        if isinstance(child, (Conv2d, Conv2dTranspose)):
+            setattr(module, name, FusedConv2d(child))
+        else:
+            _fuse_children(child)
+
+
+def check_parity(model, fused, batch_size=8, atol=1e-4, device="cpu"):
+    """Largest difference between the outputs of model and fused on random inputs, and whether it's within atol."""
+    mels = torch.randn(batch_size, 1, 80, 16, device=device)
+    faces = torch.rand(batch_size, 6, 96, 96, device=device)
+    with torch.no_grad():
+        difference = (model.eval()(mels, faces) - fused(mels, faces)).abs().max().item()
+    return difference, difference <= atol
+
+
+def load_checkpoint(path, device="cpu", model=None):
+    # a Wav2Lip, or the given model, with the weights of a training checkpoint
+    checkpoint = torch.load(path, map_location=device)
+    model = model if model is not None else Wav2Lip()
+    model.load_state_dict({k.replace("module.", ""): v for k, v in checkpoint["state_dict"].items()})
+    return model.to(device).eval()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fold the BatchNorms of a Wav2Lip checkpoint into its convs")
+    parser.add_argument("checkpoint", help="Wav2Lip checkpoint, eg: checkpoints/Wav2Lip.pth")
+    parser.add_argument("--outfile", help="Where to save the fused model, only checks it if not given")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--atol", type=float, default=1e-4, help="Largest output difference allowed")
+    args = parser.parse_args()
+
+    model = load_checkpoint(args.checkpoint)
+    fused = fuse_model(model)
+    difference, ok = check_parity(model, fused, args.batch_size, args.atol)
+    print(f"largest output difference: {difference:.2e}")
+    if not ok:
+        raise SystemExit(f"outputs differ by more than {args.atol}")
+    if args.outfile:
+        torch.save(fused, args.outfile)
+        print("saved", args.outfile)
@@ -0,0 +1,71 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_end = object()
+
+
+def prefetch(iterable, queue_size=4):
+    """Run an iterable in its own thread and hand its items over through a bounded queue.
+
+    The thread stays at most queue_size items ahead of the consumer. Exceptions are
+    re-raised in the consumer and the iterable is closed if the consumer stops early.
+    """
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((_end, None))
+        except BaseException as e:
+            put((_end, e))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while 1:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _end:
+                break
+            yield item
+    finally:
+        stop.set()
+
+
+def ordered_map(fn, iterable, workers=1, queue_size=None):
+    """Apply fn to every item on a pool of worker threads, yielding the results in input order.
+
+    At most queue_size items are being processed or waiting to be collected at once.
+    """
+    queue_size = queue_size or 2 * workers
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in iterable:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= queue_size:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
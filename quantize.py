@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+import audio
+from face_cache import file_hash
+from face_detection import detect_faces
+from model_backends import OnnxModel, export_onnx
+from models import SyncNet_color
+from models.fused import fuse_model, load_checkpoint
+from video_io import get_fps, read_frames
+
+# frames per sample, what SyncNet looks at
+SYNC_FRAMES = 5
+MEL_STEP_SIZE = 16
+IMG_SIZE = 96
+
+
+def clip_samples(path, detector, max_frames=600, pads=(0, 10, 0, 0), batch_size=8):
+    """Wav2Lip inputs from a local clip, for calibration and the quality report.
+
+    Returns faces, an (N, SYNC_FRAMES, 96, 96, 3) uint8 array of face crops, and mels, the
+    (N, SYNC_FRAMES, 80, 16) mel windows that go with them, for every run of SYNC_FRAMES
+    consecutive frames that all have a face in the first max_frames frames.
+    """
+    fps = get_fps(path)
+    with tempfile.TemporaryDirectory() as tmp:
+        wav_path = os.path.join(tmp, "audio.wav")
+        subprocess.check_call(["ffmpeg", "-y", "-loglevel", "error", "-i", path, "-ac", "1", wav_path])
+        mel = audio.melspectrogram(audio.load_wav(wav_path, 16000))
+
+    frames = list(read_frames(path, max_frames=max_frames))
+    faces = []
+    for start in range(0, len(frames), batch_size):
+        faces += detect_faces(detector, frames[start : start + batch_size])
+
+    pady1, pady2, padx1, padx2 = pads
+    crops, windows = [], []
+    for i, (frame, face) in enumerate(zip(frames, faces)):
+        # the same mel window inference uses for this frame
+        start = min(int(i * 80.0 / fps), mel.shape[1] - MEL_STEP_SIZE)
+        if face is None or start < 0:
+            crops.append(None)
+            windows.append(None)
+            continue
+        x1, y1, x2, y2 = np.asarray(face[0]).round().astype(int)
+        height, width = frame.shape[:2]
+        y1, y2 = max(0, y1 - pady1), min(height, y2 + pady2)
+        x1, x2 = max(0, x1 - padx1), min(width, x2 + padx2)
+        crops.append(cv2.resize(frame[y1:y2, x1:x2], (IMG_SIZE, IMG_SIZE)))
+        windows.append(mel[:, start : start + MEL_STEP_SIZE])
+
+    samples = []
+    for start in range(0, len(crops) - SYNC_FRAMES + 1, SYNC_FRAMES):
+        run = range(start, start + SYNC_FRAMES)
+        if all(crops[i] is not None for i in run):
+            samples.append(([crops[i] for i in run], [windows[i] for i in run]))
+    if not samples:
+        return np.zeros((0, SYNC_FRAMES, IMG_SIZE, IMG_SIZE, 3), np.uint8), np.zeros((0, SYNC_FRAMES, 80, MEL_STEP_SIZE))
+    return np.array([s[0] for s in samples]), np.array([s[1] for s in samples])
+
+
+def model_inputs(faces, mels):
+    # (mel, face) batches as Wav2Lip takes them, prepared like inference's prepare_batch
+    faces = faces.reshape((-1,) + faces.shape[-3:])
+    masked = faces.copy()
+    masked[:, IMG_SIZE // 2 :] = 0
+    img_batch = np.concatenate((masked, faces), axis=3).transpose(0, 3, 1, 2) / 255.0
+    mel_batch = mels.reshape((-1, 1) + mels.shape[-2:])
+    return torch.FloatTensor(mel_batch), torch.FloatTensor(img_batch)
+
+
+def _batches(faces, mels, batch_size):
+    for start in range(0, len(faces), batch_size):
+        yield model_inputs(faces[start : start + batch_size], mels[start : start + batch_size])
+
+
+def quantize(model, faces, mels, outfile, batch_size=16, fp32_outfile=None):
+    """Save an INT8 ONNX copy of model in outfile, statically quantized with ranges calibrated on faces and mels.
+
+    Weights are quantized per channel and activations per tensor, in QDQ format, which
+    onnxruntime runs with its INT8 kernels. The fp32 ONNX model it's quantized from is
+    kept in fp32_outfile if given, eg: to compare the two.
+    """
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = _batches(faces, mels, batch_size)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            if batch is None:
+                return None
+            return {"input0": batch[0].numpy(), "input1": batch[1].numpy()}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fp32_path = fp32_outfile or os.path.join(tmp, "fp32.onnx")
+        prepared_path = os.path.join(tmp, "prepared.onnx")
+        export_onnx(fuse_model(model), next(_batches(faces, mels, batch_size)), fp32_path)
+        quant_pre_process(fp32_path, prepared_path)
+        quantize_static(
+            prepared_path,
+            outfile,
+            Reader(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+
+
+def mouth_psnr(a, b):
+    # PSNR of every predicted face's lower half, the part Wav2Lip generates, for images in 0-1
+    error = ((a[:, :, IMG_SIZE // 2 :] - b[:, :, IMG_SIZE // 2 :]) ** 2).mean(axis=(1, 2, 3))
+    return 10 * np.log10(1 / np.maximum(error, 1e-10))
+
+
+def sync_distances(syncnet, preds, mels):
+    """SyncNet distance (1 - cosine similarity of the embeddings, lower is better in sync) of every sample.
+
+    preds are the (N * SYNC_FRAMES, 3, 96, 96) predicted faces, mels the (N, SYNC_FRAMES, 80, 16) windows.
+    """
+    lower = preds[:, :, IMG_SIZE // 2 :].reshape((-1, SYNC_FRAMES * 3, IMG_SIZE // 2, IMG_SIZE))
+    with torch.no_grad():
+        audio_embedding, face_embedding = syncnet(torch.FloatTensor(mels[:, :1]), torch.FloatTensor(lower))
+    return 1 - (audio_embedding * face_embedding).sum(dim=1).numpy()
+
+
+def quality_report(model, quantized, faces, mels, syncnet=None, batch_size=16):
+    """How much the quantized model differs from model on the samples, and how much faster it is.
+
+    model should run the same way as quantized, eg: both OnnxModels of the fp32 and INT8
+    exports, so the speedup is only the quantization's.
+    """
+    preds = {"fp32": [], "int8": []}
+    seconds = {"fp32": 0.0, "int8": 0.0}
+    with torch.no_grad():
+        warmup = next(_batches(faces, mels, batch_size))
+        model(*warmup), quantized(*warmup)  # the first run of a session is slower
+        for mel_batch, img_batch in _batches(faces, mels, batch_size):
+            for name, m in [("fp32", model), ("int8", quantized)]:
+                start = time.perf_counter()
+                preds[name].append(m(mel_batch, img_batch).numpy())
+                seconds[name] += time.perf_counter() - start
+    fp32, int8 = np.concatenate(preds["fp32"]), np.concatenate(preds["int8"])
+
+    psnr = mouth_psnr(fp32, int8)
+    report = {
+        "samples": len(faces),
+        "mouth_psnr_mean": float(psnr.mean()),
+        "mouth_psnr_min": float(psnr.min()),
+        "speedup": seconds["fp32"] / max(seconds["int8"], 1e-9),
+    }
+    if syncnet is not None:
+        report["sync_distance_fp32"] = float(sync_distances(syncnet, fp32, mels).mean())
+        report["sync_distance_int8"] = float(sync_distances(syncnet, int8, mels).mean())
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize Wav2Lip to INT8 for CPU inference, calibrated on local clips")
+    parser.add_argument("checkpoint", help="Wav2Lip checkpoint, eg: checkpoints/Wav2Lip.pth")
+    parser.add_argument("clips", nargs="+", help="Videos of talking faces to calibrate on, like the ones you'll use")
+    parser.add_argument("--outfile", help="Quantized model, the checkpoint's name ending in _int8.onnx by default")
+    parser.add_argument("--syncnet", help="SyncNet checkpoint (lipsync_expert.pth) to add sync distances to the report")
+    parser.add_argument("--max_frames", type=int, default=600, help="Frames read from each clip")
+    parser.add_argument("--holdout", type=float, default=0.25, help="Share of the samples kept for the report")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--detector", default="checkpoints/mobilenet.pth")
+    args = parser.parse_args()
+
+    from batch_face import RetinaFace
+
+    detector = RetinaFace(gpu_id=-1, model_path=args.detector, network="mobilenet")
+    samples = [clip_samples(clip, detector, args.max_frames) for clip in args.clips]
+    faces = np.concatenate([s[0] for s in samples])
+    mels = np.concatenate([s[1] for s in samples])
+    if len(faces) < 2:
+        raise SystemExit("Not enough frames with a face in the clips to calibrate on")
+
+    # every few samples are held out of calibration so the report isn't measured on what was calibrated on
+    report_every = max(2, round(1 / max(args.holdout, 1e-3)))
+    held_out = np.arange(len(faces)) % report_every == 0
+    print(f"{(~held_out).sum()} calibration and {held_out.sum()} report samples of {SYNC_FRAMES} frames")
+
+    outfile = args.outfile or os.path.splitext(args.checkpoint)[0] + "_int8.onnx"
+    model = load_checkpoint(args.checkpoint)
+    syncnet = load_checkpoint(args.syncnet, model=SyncNet_color()) if args.syncnet else None
+    with tempfile.TemporaryDirectory() as tmp:
+        # the INT8 model is compared with the fp32 export it came from, under the same onnxruntime options
+        fp32_path = os.path.join(tmp, "fp32.onnx")
+        quantize(model, faces[~held_out], mels[~held_out], outfile, args.batch_size, fp32_path)
+        fp32, int8 = OnnxModel(fp32_path), OnnxModel(outfile)
+        report = quality_report(fp32, int8, faces[held_out], mels[held_out], syncnet, args.batch_size)
+    for name, value in report.items():
+        print(f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}")
+
+    # the report and where the model came from are saved next to it
+    with open(os.path.splitext(outfile)[0] + ".json", "w") as f:
+        info = {
+            "format": "onnx-qdq-int8",
+            "checkpoint": os.path.basename(args.checkpoint),
+            "checkpoint_hash": file_hash(args.checkpoint),
+            "clips": [os.path.basename(clip) for clip in args.clips],
+            "report": report,
+        }
+        json.dump(info, f, indent=2)
+    print("saved", outfile)
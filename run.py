@@ -7,12 +7,10 @@ from easy_functions import (format_time,
                             get_video_details,
                             show_video,
                             g_colab)
-import contextlib
 import shutil
 import subprocess
 import time
 from IPython.display import Audio, Image, clear_output, display
-from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
 import configparser
 
 parser = argparse.ArgumentParser(description='Easy-Wav2Lip main run file')
@@ -50,10 +48,13 @@ R = config.getint('PADDING', 'R')
 size = config.getfloat('MASK', 'size')
 feathering = config.getint('MASK', 'feathering')
 mouth_tracking = config.getboolean('MASK', 'mouth_tracking')
+mouth_landmarks = config.get('MASK', 'mouth_landmarks', fallback='hog')
 debug_mask = config.getboolean('MASK', 'debug_mask')
 batch_process = config.getboolean('OTHER', 'batch_process')
 output_suffix = config['OTHER']['output_suffix']
 include_settings_in_suffix = config.getboolean('OTHER', 'include_settings_in_suffix')
+speaker_files = [f.strip().strip('"') for f in config.get('OTHER', 'speaker_files', fallback='').split(';') if f.strip()]
+speaker_faces = config.get('OTHER', 'speaker_faces', fallback='').split()
 
 if g_colab():
     preview_input = config.getboolean("OTHER", "preview_input")
@@ -61,6 +62,28 @@ else:
     preview_input = False
 preview_settings = config.getboolean("OTHER", "preview_settings")
 frame_to_preview = config.getint("OTHER", "frame_to_preview")
+streaming = config.getboolean("PERFORMANCE", "streaming", fallback=False)
+decoder = config.get("PERFORMANCE", "decoder", fallback="opencv")
+encoder = config.get("PERFORMANCE", "encoder", fallback="opencv")
+x264_preset = config.get("PERFORMANCE", "x264_preset", fallback="medium")
+x264_crf = config.getint("PERFORMANCE", "x264_crf", fallback=23)
+pipeline = config.getboolean("PERFORMANCE", "pipeline", fallback=False)
+fuse_model = config.getboolean("PERFORMANCE", "fuse_model", fallback=True)
+model_backend = config.get("PERFORMANCE", "model_backend", fallback="eager")
+precision = config.get("PERFORMANCE", "precision", fallback="fp32")
+channels_last = config.getboolean("PERFORMANCE", "channels_last", fallback=False)
+int8_model = config.get("PERFORMANCE", "int8_model", fallback="")
+face_cache_size = config.getint("PERFORMANCE", "face_cache_size", fallback=2048)
+face_detection_size = config.get("PERFORMANCE", "face_detection_size", fallback="full")
+face_detection_workers = config.getint("PERFORMANCE", "face_detection_workers", fallback=0)
+detect_every = config.getint("PERFORMANCE", "detect_every", fallback=1)
+box_filter = config.get("PERFORMANCE", "box_filter", fallback="mean")
+scene_cut_threshold = config.getfloat("PERFORMANCE", "scene_cut_threshold", fallback=0)
+faceless_probe = config.getint("PERFORMANCE", "faceless_probe", fallback=8)
+missing_face = config.get("PERFORMANCE", "missing_face", fallback="interpolate")
+max_face_gap = config.getint("PERFORMANCE", "max_face_gap", fallback=10)
+blend_workers = config.getint("PERFORMANCE", "blend_workers", fallback=2)
+landmark_workers = config.getint("PERFORMANCE", "landmark_workers", fallback=4)
 
 working_directory = os.getcwd()
 
@@ -254,19 +277,14 @@ while True:
     shutil.copy(input_video, temp_folder)
     shutil.copy(input_audio, temp_folder)
 
-    # rename temp file to include padding or else changing padding does nothing
+    # the face detection cache is keyed by the video's content and the padding,
+    # so the temp file no longer needs renaming when the padding changes
     temp_input_video = os.path.join(temp_folder, input_videofile)
-    renamed_temp_input_video = os.path.join(
-        temp_folder, str(U) + str(D) + str(L) + str(R) + input_videofile
-    )
-    shutil.copy(temp_input_video, renamed_temp_input_video)
-    temp_input_video = renamed_temp_input_video
-    temp_input_videofile = os.path.basename(renamed_temp_input_video)
     temp_input_audio = os.path.join(temp_folder, input_audiofile)
 
-    # trim video if it's longer than the audio
+    # inference.py stops decoding once it has enough frames for the audio, so
+    # there is no need to trim the video when it's longer than the audio
     video_length = get_input_length(temp_input_video)
-    audio_length = get_input_length(temp_input_audio)
 
     if preview_settings:
         batch_process = False
@@ -325,27 +343,6 @@ while True:
         temp_input_video = preview_video_path
         temp_input_audio = preview_audio_path
 
-    if video_length > audio_length:
-        trimmed_video_path = os.path.join(
-            temp_folder, "trimmed_" + temp_input_videofile
-        )
-        with open(os.devnull, "w") as devnull:
-            with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(
-                devnull
-            ):
-                ffmpeg_extract_subclip(
-                    temp_input_video, 0, audio_length, targetname=trimmed_video_path
-                )
-        temp_input_video = trimmed_video_path
-    # check if face detection has already happened on this clip
-    last_detected_face = os.path.join(working_directory, "last_detected_face.pkl")
-    if os.path.isfile("last_file.txt"):
-        with open("last_file.txt", "r") as file:
-            last_file = file.readline()
-        if last_file != temp_input_video or use_previous_tracking_data == "False":
-            if os.path.isfile(last_detected_face):
-                os.remove(last_detected_face)
-
     # ----------------------------Process the inputs!-----------------------------!
     print(
         f"Processing{' preview of' if preview_settings else ''} "
@@ -388,7 +385,56 @@ while True:
         str(preview_settings),
         "--mouth_tracking",
         str(mouth_tracking),
+        "--mouth_landmarks",
+        mouth_landmarks,
+        "--decoder",
+        decoder,
+        "--encoder",
+        encoder,
+        "--x264_preset",
+        x264_preset,
+        "--x264_crf",
+        str(x264_crf),
+        "--face_cache_size",
+        str(face_cache_size),
+        "--face_det_workers",
+        str(face_detection_workers),
+        "--detect_every",
+        str(detect_every),
+        "--box_filter",
+        box_filter,
+        "--scene_cut_threshold",
+        str(scene_cut_threshold),
+        "--faceless_probe",
+        str(faceless_probe),
+        "--missing_face",
+        missing_face,
+        "--max_face_gap",
+        str(max_face_gap),
     ]
+    # face detection results are cached per video by inference.py
+    if use_previous_tracking_data == "False":
+        cmd.append("--redo_face_detection")
+    if face_detection_size == "auto":
+        cmd.append("--face_det_auto")
+    elif face_detection_size != "full":
+        cmd += ["--face_det_size", face_detection_size]
+    if streaming:
+        cmd.append("--streaming")
+    if fuse_model:
+        cmd.append("--fuse_model")
+    cmd += ["--model_backend", model_backend, "--precision", precision]
+    if channels_last:
+        cmd.append("--channels_last")
+    if int8_model:
+        cmd += ["--int8_model", int8_model]
+    if pipeline:
+        cmd += ["--pipeline", "--blend_workers", str(blend_workers)]
+    cmd += ["--landmark_workers", str(landmark_workers)]
+    if speaker_files:
+        cmd += ["--track_audio"] + speaker_files
+        if speaker_faces:
+            cmd += ["--track_faces"] + speaker_faces
 
     # Run the command
     subprocess.run(cmd)
@@ -0,0 +1,83 @@
+from itertools import islice
+
+import cv2
+import numpy as np
+
+
+def signatures(images, size=32):
+    """Small grayscale thumbnails of a batch of images, as one (N, size, size) array."""
+    return np.stack(
+        [
+            cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (size, size), interpolation=cv2.INTER_AREA)
+            for image in images
+        ]
+    )
+
+
+def histograms(thumbnails, bins=32):
+    # normalized histograms of the whole batch in one bincount, offsetting every image into its own bins
+    n = len(thumbnails)
+    values = thumbnails.reshape(n, -1).astype(np.int64) * bins // 256
+    values += np.arange(n)[:, None] * bins
+    counts = np.bincount(values.ravel(), minlength=n * bins).reshape(n, bins)
+    return counts / values.shape[1]
+
+
+class SceneCutDetector:
+    """Finds hard cuts between shots by comparing each frame with the one before it.
+
+    A frame is a cut when both its brightness histogram and its downscaled picture are
+    very different from the previous frame's: a camera move changes the picture but not
+    the histogram, a lighting change the histogram but not the picture. threshold is the
+    histogram distance (0 to 1) and min_diff the mean pixel difference (0 to 255).
+    The detector keeps the last frame it saw, so batches can be passed in one after the other.
+    """
+
+    def __init__(self, threshold=0.3, min_diff=20.0, size=32, bins=32):
+        self.threshold = threshold
+        self.min_diff = min_diff
+        self.size = size
+        self.bins = bins
+        self.reset()
+
+    def reset(self):
+        self.prev_thumbnail = self.prev_histogram = None
+
+    def find(self, images):
+        """Boolean array with True for every image that starts a new shot."""
+        if len(images) == 0:
+            return np.zeros(0, dtype=bool)
+        thumbnails = signatures(images, self.size)
+        hists = histograms(thumbnails, self.bins)
+
+        # the first frame of the video has nothing to be cut from
+        if self.prev_thumbnail is None:
+            self.prev_thumbnail, self.prev_histogram = thumbnails[:1], hists[:1]
+        prev_thumbnails = np.concatenate([self.prev_thumbnail, thumbnails[:-1]])
+        prev_hists = np.concatenate([self.prev_histogram, hists[:-1]])
+        self.prev_thumbnail, self.prev_histogram = thumbnails[-1:], hists[-1:]
+
+        hist_distance = np.abs(hists - prev_hists).sum(axis=1) / 2
+        pixel_diff = np.abs(thumbnails.astype(np.int16) - prev_thumbnails).mean(axis=(1, 2))
+        return (hist_distance > self.threshold) & (pixel_diff > self.min_diff)
+
+
+def mark_cuts(images, detector=None, batch_size=8):
+    """Yield (image, cut) for every image, with the cuts found batch_size images at a time.
+
+    Without a detector no image is a cut.
+    """
+    images = iter(images)
+    while 1:
+        batch = list(islice(images, batch_size))
+        if not batch:
+            break
+        cuts = detector.find(batch) if detector is not None else np.zeros(len(batch), dtype=bool)
+        yield from zip(batch, cuts.tolist())
+
+
+def spans(flags):
+    """(start, end) of every run of True in a boolean array, end exclusive."""
+    flags = np.concatenate([[False], np.asarray(flags, dtype=bool), [False]])
+    edges = np.flatnonzero(np.diff(flags.astype(np.int8)))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
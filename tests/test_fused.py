@@ -0,0 +1,31 @@
+import torch
+
+from models import Wav2Lip, fuse_model
+from models.fused import FusedConv2d, check_parity
+
+
+def random_model():
+    # random weights with BatchNorm statistics far from the identity defaults, so folding them matters
+    torch.manual_seed(0)
+    model = Wav2Lip().eval()
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.2, 0.2)
+    return model
+
+
+def test_fused_model_matches():
+    model = random_model()
+    fused = fuse_model(model)
+    difference, ok = check_parity(model, fused, batch_size=2, atol=1e-4)
+    assert ok, difference
+
+
+def test_fused_model_has_no_batchnorm():
+    fused = fuse_model(random_model())
+    assert isinstance(fused, Wav2Lip)
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in fused.modules())
+    assert any(isinstance(m, FusedConv2d) for m in fused.modules())
@@ -0,0 +1,66 @@
+import random
+import time
+
+import numpy as np
+
+from masks import MaskEngine, MaskTemplates, feathered_mouth_mask
+from pipeline import ordered_map
+
+MOUTH = np.array([[80, 150], [100, 142], [120, 150], [100, 157]])
+
+
+def test_template_matches_mask_on_crop():
+    # dilated past the crop's edges, where both must clip the same way
+    for dilation, feathering in [(2.5, 2), (1.5, 3)]:
+        templates = MaskTemplates(dilation, feathering, always_blur=True)
+        shape = (200, 200, 3)
+        expected = feathered_mouth_mask(shape, MOUTH, dilation, feathering, always_blur=True)
+        np.testing.assert_array_equal(templates.mask(shape, MOUTH), expected)
+
+
+def test_moved_template_close_to_mask():
+    rng = np.random.default_rng(0)
+    templates = MaskTemplates(2.5, 2, always_blur=True)
+    templates.mask((200, 200, 3), MOUTH)
+    for _ in range(20):
+        shape = (200 + rng.integers(-3, 4), 200 + rng.integers(-3, 4), 3)
+        mouth = (MOUTH * rng.uniform(0.99, 1.01) + rng.integers(-2, 3, 2)).round()
+        expected = feathered_mouth_mask(shape, mouth, 2.5, 2, always_blur=True)
+        difference = np.abs(templates.mask(shape, mouth).astype(int) - expected)
+        assert difference.mean() < 2
+        assert difference.max() < 64
+
+
+def test_template_stays_crop_sized():
+    # huge dilations used to make the template canvas thousands of pixels wide
+    templates = MaskTemplates(150, 151, always_blur=True)
+    mouth = np.array([[10, 20], [30, 14], [50, 20], [30, 27]])
+    mask = templates.mask((64, 64, 3), mouth)
+    assert mask.shape == (64, 64)
+    assert all(image.shape == (64, 64) for image, _ in templates.templates.values())
+
+
+def test_first_mask_in_batch_order():
+    # the untracked mask is the first face's however the blend workers are scheduled
+    engine = MaskEngine(predictor=None)
+
+    def first_mask(face, landmarks):
+        if engine.last_mask is None:
+            time.sleep(random.random() * 0.005)
+            engine.last_mask = face
+        return engine.last_mask
+
+    engine._mask = first_mask
+
+    def blend(numbered):
+        index, face = numbered
+        time.sleep(random.random() * 0.005)
+        try:
+            return engine.compute([] if index == 0 else [face], None, index)  # the first batch has no face
+        finally:
+            engine.finish(index)
+
+    for _ in range(10):
+        engine.reset()
+        masks = list(ordered_map(blend, enumerate(range(12)), 4, 4))
+        assert masks[0] == [] and all(m == [1] for m in masks[1:])
@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+import model_backends
+from model_backends import CompiledModel, OnnxModel, export_onnx, supported_precision
+from models import Wav2Lip
+from models.fused import check_parity
+
+
+def test_onnxruntime_matches_eager(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    torch.manual_seed(0)
+    model = Wav2Lip().eval()
+    inputs = (torch.randn(2, 1, 80, 16), torch.rand(2, 6, 96, 96))
+    path = str(tmp_path / "wav2lip.onnx")
+    export_onnx(model, inputs, path)
+
+    # a different batch size than it was exported with, the batch axis is dynamic
+    difference, ok = check_parity(model, OnnxModel(path), batch_size=3, atol=1e-4)
+    assert ok, difference
+
+
+def test_onnxruntime_backend_caches_export(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    torch.manual_seed(0)
+    model = Wav2Lip().eval()
+    compiled = CompiledModel(model, "onnxruntime", cache_dir=str(tmp_path))
+    difference, ok = check_parity(model, compiled, batch_size=2, atol=1e-4)
+    assert ok, difference
+    assert isinstance(compiled.compiled, OnnxModel)
+    assert len(list(tmp_path.glob("*.onnx"))) == 1
+
+
+def test_bf16_falls_back_without_cpu_support(monkeypatch):
+    monkeypatch.setattr(model_backends, "_cpu_has_bf16", lambda: False)
+    assert supported_precision("bf16", "cpu") == "fp32"
+    monkeypatch.setattr(model_backends, "_cpu_has_bf16", lambda: True)
+    assert supported_precision("bf16", "cpu") == "bf16"
+    assert supported_precision("fp16", "cpu") == "fp32"
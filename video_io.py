@@ -0,0 +1,219 @@
+import json
+import subprocess
+
+import cv2
+import numpy as np
+
+
+def prepare_frame(frame, out_height=None, rotate=False, crop=(0, -1, 0, -1)):
+    if out_height is not None:
+        aspect_ratio = frame.shape[1] / frame.shape[0]
+        frame = cv2.resize(frame, (int(out_height * aspect_ratio), out_height))
+
+    if rotate:
+        frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+
+    y1, y2, x1, x2 = crop
+    if x2 == -1:
+        x2 = frame.shape[1]
+    if y2 == -1:
+        y2 = frame.shape[0]
+
+    return frame[y1:y2, x1:x2]
+
+
+def read_frames(
+    path, out_height=None, rotate=False, crop=(0, -1, 0, -1), max_frames=None
+):
+    """Decode a video one frame at a time, applying the resize/rotate/crop options.
+
+    Only the frame being yielded is held in memory, so callers decide how many
+    frames they keep alive. Decoding stops after max_frames frames.
+    """
+    video_stream = cv2.VideoCapture(path)
+    try:
+        frame_count = 0
+        while max_frames is None or frame_count < max_frames:
+            still_reading, frame = video_stream.read()
+            if not still_reading:
+                break
+            frame_count += 1
+            yield prepare_frame(frame, out_height, rotate, crop)
+    finally:
+        video_stream.release()
+
+
+def get_fps(path):
+    video_stream = cv2.VideoCapture(path)
+    fps = video_stream.get(cv2.CAP_PROP_FPS)
+    video_stream.release()
+    return fps
+
+
+def get_frame_size(path):
+    """Width and height of the decoded frames, after any rotation metadata is applied."""
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_streams",
+            "-of",
+            "json",
+            path,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    video_stream = json.loads(result.stdout)["streams"][0]
+    width = int(video_stream["width"])
+    height = int(video_stream["height"])
+
+    # phone videos store their orientation as metadata, which ffmpeg (and OpenCV) apply when decoding
+    rotation = video_stream.get("tags", {}).get("rotate", 0)
+    for side_data in video_stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    if abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+
+    return width, height
+
+
+def read_frames_ffmpeg(
+    path,
+    out_height=None,
+    rotate=False,
+    crop=(0, -1, 0, -1),
+    max_frames=None,
+    pix_fmt="bgr24",
+    chunk_size=8,
+):
+    """Same as read_frames, but decodes with an ffmpeg subprocess.
+
+    Resizing, rotating and cropping are done in ffmpeg's filter graph and the raw
+    frames are read from its stdout straight into preallocated numpy arrays.
+    """
+    width, height = get_frame_size(path)
+    filters = []
+
+    if out_height is not None:
+        aspect_ratio = width / height
+        width, height = int(out_height * aspect_ratio), out_height
+        filters.append(f"scale={width}:{height}:flags=bilinear")
+
+    if rotate:
+        filters.append("transpose=clock")
+        width, height = height, width
+
+    y1, y2, x1, x2 = crop
+    if x2 == -1:
+        x2 = width
+    if y2 == -1:
+        y2 = height
+    # clamp the same way numpy slicing does in prepare_frame
+    x1, x2, _ = slice(x1, x2).indices(width)
+    y1, y2, _ = slice(y1, y2).indices(height)
+    if (x1, y1, x2, y2) != (0, 0, width, height):
+        filters.append(f"crop={x2 - x1}:{y2 - y1}:{x1}:{y1}")
+        width, height = x2 - x1, y2 - y1
+
+    cmd = ["ffmpeg", "-loglevel", "error", "-i", path, "-an", "-sn"]
+    if filters:
+        cmd += ["-vf", ",".join(filters)]
+    if max_frames is not None:
+        cmd += ["-frames:v", str(max_frames)]
+    # pass frames through as decoded rather than duplicating/dropping them to a constant rate
+    cmd += ["-vsync", "0", "-f", "rawvideo", "-pix_fmt", pix_fmt, "pipe:1"]
+
+    frame_bytes = width * height * 3
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        while 1:
+            # frames are handed out as views of a block that is filled in place,
+            # a new block is only allocated once the previous one is used up
+            block = np.empty((chunk_size, height, width, 3), dtype=np.uint8)
+            for frame in block:
+                if _read_into(process.stdout, frame) < frame_bytes:
+                    return
+                yield frame
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def _read_into(stream, array):
+    buffer = memoryview(array).cast("B")
+    total = 0
+    while total < len(buffer):
+        n = stream.readinto(buffer[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+
+class FFmpegWriter:
+    """Drop-in replacement for cv2.VideoWriter that pipes raw frames into ffmpeg.
+
+    The frames are encoded with libx264 and the audio is muxed by the same ffmpeg
+    process, so the output file is final as soon as release() returns.
+    """
+
+    def __init__(
+        self,
+        path,
+        fps,
+        frame_size,
+        audio=None,
+        preset="medium",
+        crf=23,
+        threads=0,
+        pix_fmt="bgr24",
+    ):
+        width, height = frame_size
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            pix_fmt,
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "pipe:0",
+        ]
+        if audio is not None:
+            cmd += ["-i", audio, "-map", "0:v", "-map", "1:a"]
+        cmd += [
+            # yuv420p needs even dimensions, pad by a pixel rather than fail
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v",
+            "libx264",
+            "-preset",
+            preset,
+            "-crf",
+            str(crf),
+            "-threads",
+            str(threads),
+            "-pix_fmt",
+            "yuv420p",
+            path,
+        ]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, "ffmpeg")